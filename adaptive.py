@@ -0,0 +1,286 @@
+"""Adaptive scheduling of ResolutionWR trials.
+
+Instead of running trials_per_set_size trials of every set size in each block, the scheduler keeps
+running mixture model estimates of each set size's guess rate and precision (SD), and gives the
+next trial to the set size whose estimates are the least precise. The session ends once every set
+size reaches the target precision, or when the trial or time budget runs out.
+
+The scheduler plugs into the run hooks:
+
+    scheduler = adaptive.AdaptiveScheduler(exp, target_sd_se=2, target_guess_se=0.05)
+    exp.run(pre_block_hook=scheduler.pre_block_hook, post_trial_hook=scheduler.post_trial_hook)
+
+Classes:
+AdaptiveScheduler -- Assigns trials to the set sizes with the least precise estimates.
+
+Functions:
+simulate_schedule -- Runs a scheduler with a model observer instead of a participant.
+"""
+
+
+import concurrent.futures
+import math
+import time
+
+import numpy as np
+
+import analysis
+
+
+class AdaptiveScheduler(object):
+    """
+    Assigns trials to the set sizes with the least precise estimates.
+
+    The mixture model (see analysis.fit_mixture) is fit again to a set size's errors after each of its
+    trials. The fit runs on a worker thread during the next trial, so the trial loop does not wait for
+    it, and the next trial is chosen from the fits of the trials before the last one. The standard error
+    of the guess rate is the binomial one, and the standard error of the SD comes from the variance of
+    the von Mises distribution of the remembered responses. The uncertainty of a set size is the larger
+    of its two standard errors divided by their targets.
+
+    The schedule only depends on the recorded errors and seed, so with a seed and no max_duration the
+    same responses always give the same trials (see simulate_schedule).
+
+    Parameters:
+    experiment -- The ResolutionWR (or wrcore.TrialGenerator) that makes the trials.
+    target_sd_se -- The session can end once the standard error of the SD of every set size is below
+        this many degrees. None ignores the SD.
+    target_guess_se -- The session can end once the standard error of the guess rate of every set size
+        is below this. None ignores the guess rate.
+    min_trials -- The number of trials of each set size before its estimates are used.
+    max_trials -- The maximum number of trials in the session. Defaults to the number of trials the
+        fixed design would run.
+    max_duration -- The maximum number of seconds from the start of the first block. None has no limit.
+    trials_per_block -- The maximum number of trials per block. Defaults to the fixed block length.
+    seed -- Seed for breaking ties between set sizes. None gives a different order every time.
+    clock -- A function returning the current time in seconds.
+
+    Methods:
+    choose_set_size -- Returns the set size the next trial should use.
+    done -- Returns True once the session should end.
+    estimates -- Returns the current estimates and their standard errors for every set size.
+    post_trial_hook -- Records the errors of a trial. Send as the post_trial_hook of run.
+    pre_block_hook -- Returns the trials of the next block. Send as the pre_block_hook of run.
+    record -- Records the errors of one trial and updates the estimates of its set size.
+    """
+    def __init__(self, experiment, target_sd_se=2, target_guess_se=0.05, min_trials=5, max_trials=None,
+                 max_duration=None, trials_per_block=None, seed=None, clock=time.monotonic):
+        if target_sd_se is None and target_guess_se is None:
+            raise ValueError('At least one of target_sd_se and target_guess_se must be set.')
+
+        self.experiment = experiment
+        self.target_sd_se = target_sd_se
+        self.target_guess_se = target_guess_se
+        self.min_trials = min_trials
+        self.max_duration = max_duration
+        self.clock = clock
+
+        if trials_per_block is None:
+            trials_per_block = experiment.trials_per_set_size * len(experiment.set_sizes)
+        self.trials_per_block = trials_per_block
+
+        if max_trials is None:
+            max_trials = trials_per_block * experiment.number_of_blocks
+        self.max_trials = max_trials
+
+        self.rng = np.random.default_rng(seed)
+        self.start_time = None
+        self.n_trials = 0
+
+        self._errors = {set_size: [] for set_size in experiment.set_sizes}
+        self._trials = {set_size: 0 for set_size in experiment.set_sizes}
+        self._fits = {set_size: None for set_size in experiment.set_sizes}
+        self._pending = None  # the (set_size, future) of the fit started by the last record
+        self._worker = None
+
+    def _apply_fit(self):
+        # Waits for the fit started by the last record, which has had a whole trial to finish
+        if self._pending is not None:
+            set_size, fit = self._pending
+            self._fits[set_size] = fit.result()
+            self._pending = None
+
+    def _standard_errors(self, set_size, fits=None):
+        fit = (fits if fits is not None else self._fits)[set_size]
+        if fit is None or self._trials[set_size] < self.min_trials:
+            return math.inf, math.inf
+
+        # Every recorded response counts, including those of a trial whose fit is still running, so a
+        # set size is not chosen again just because its last trial is not in its estimates yet
+        n = len(self._errors[set_size])
+        guess_rate = fit['GuessRate']
+        guess_se = math.sqrt(max(guess_rate * (1 - guess_rate), 1 / n) / n)
+
+        # The SD is sqrt(-2 log A1(kappa)), and the mean cosine of n_target von Mises errors has a
+        # variance of (1 - A1(kappa) / kappa - A1(kappa) ** 2) / n_target, so the delta method gives its SE
+        n_target = n * (1 - guess_rate)
+        kappa = fit['Kappa']
+        sd = math.radians(fit['SD'])
+        a1 = math.exp(-sd ** 2 / 2)
+        if n_target < 2 or kappa <= 0 or not 0 < a1 < 1:
+            return math.inf, guess_se
+
+        cos_variance = max(1 - a1 / kappa - a1 ** 2, 0)
+        sd_se = math.degrees(math.sqrt(cos_variance / n_target) / (a1 * sd))
+
+        return sd_se, guess_se
+
+    def _uncertainty(self, set_size):
+        sd_se, guess_se = self._standard_errors(set_size)
+
+        uncertainty = 0
+        if self.target_sd_se is not None:
+            uncertainty = max(uncertainty, sd_se / self.target_sd_se)
+        if self.target_guess_se is not None:
+            uncertainty = max(uncertainty, guess_se / self.target_guess_se)
+
+        return uncertainty
+
+    def estimates(self):
+        """
+        Returns the current estimates and their standard errors for every set size.
+
+        The dict is keyed by set size and holds the number of trials and responses, the guess rate and
+        SD (None until a set size has min_trials trials) and their standard errors. Unlike the estimates
+        used to choose trials, these include the last trial, so this waits for its fit.
+        """
+        fits = dict(self._fits)
+        if self._pending is not None:
+            fits[self._pending[0]] = self._pending[1].result()
+
+        estimates = {}
+
+        for set_size in self._trials:
+            fit = fits[set_size] if self._trials[set_size] >= self.min_trials else None
+            sd_se, guess_se = self._standard_errors(set_size, fits)
+            estimates[set_size] = {
+                'Trials': self._trials[set_size],
+                'Responses': len(self._errors[set_size]),
+                'GuessRate': fit['GuessRate'] if fit is not None else None,
+                'GuessRateSE': guess_se,
+                'SD': fit['SD'] if fit is not None else None,
+                'SDSE': sd_se,
+            }
+
+        return estimates
+
+    def choose_set_size(self):
+        """
+        Returns the set size the next trial should use.
+
+        Set sizes with fewer than min_trials trials come first, then the set size with the largest
+        uncertainty. Ties are broken at random.
+        """
+        set_sizes = list(self._trials)
+        too_few = [s for s in set_sizes if self._trials[s] < self.min_trials]
+
+        if too_few:
+            fewest = min(self._trials[s] for s in too_few)
+            candidates = [s for s in too_few if self._trials[s] == fewest]
+        else:
+            uncertainties = {s: self._uncertainty(s) for s in set_sizes}
+            largest = max(uncertainties.values())
+            candidates = [s for s in set_sizes if uncertainties[s] == largest]
+
+        return candidates[self.rng.integers(len(candidates))]
+
+    def done(self):
+        """Returns True once every set size reaches the target precision or the trial or time budget is used up."""
+        if self.n_trials >= self.max_trials:
+            return True
+
+        if self.max_duration is not None and self.start_time is not None:
+            if self.clock() - self.start_time >= self.max_duration:
+                return True
+
+        return all(self._uncertainty(set_size) <= 1 for set_size in self._trials)
+
+    def record(self, set_size, errors):
+        """
+        Records the errors of one trial and updates the estimates of its set size.
+
+        The fit is started on a worker thread, and is applied when the next trial is recorded, after
+        waiting for it if it has not finished yet.
+
+        Parameters:
+            set_size -- The set size of the trial.
+            errors -- The errors of the trial in wheel entries, as calculated by the experiment.
+                Missing errors (None) are skipped.
+        """
+        self._apply_fit()
+
+        wheel_size = self.experiment.wheel_size
+        self._errors[set_size].extend(2 * math.pi * error / wheel_size for error in errors if error is not None)
+        self._trials[set_size] += 1
+        self.n_trials += 1
+
+        if self._trials[set_size] >= self.min_trials and self._errors[set_size]:
+            if self._worker is None:
+                self._worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._pending = set_size, self._worker.submit(
+                analysis.fit_mixture, list(self._errors[set_size]), max_iterations=500, tolerance=1e-4)
+
+    def _block(self, experiment, block_num):
+        for _ in range(self.trials_per_block):
+            if self.done():
+                # Lowering number_of_blocks makes run end the session after this block
+                experiment.number_of_blocks = block_num + 1
+                return
+            yield experiment.make_trial(self.choose_set_size())
+
+    def pre_block_hook(self, experiment, block, block_num):
+        """
+        Returns the trials of the next block. Send as the pre_block_hook of run.
+
+        The trials are made one at a time, so each one uses the estimates from all of the trials before
+        it. The planned block is ignored.
+
+        Parameters:
+            experiment -- The experiment, sent by run.
+            block -- The planned block, sent by run.
+            block_num -- The block number, sent by run.
+        """
+        if self.start_time is None:
+            self.start_time = self.clock()
+
+        return self._block(experiment, block_num)
+
+    def post_trial_hook(self, experiment, data):
+        """
+        Records the errors of a trial. Send as the post_trial_hook of run.
+
+        Parameters:
+            experiment -- The experiment, sent by run.
+            data -- The list of row dicts returned by run_trial. It is not changed.
+        """
+        if data:
+            self.record(data[0]['SetSize'], [row['Error'] for row in data])
+
+
+def simulate_schedule(scheduler, observer, seed=None):
+    """
+    Runs a scheduler with a model observer instead of a participant.
+
+    Returns the list of set sizes in the order they were run. With seeds for the experiment, the
+    scheduler and this function, the result is always the same, so schedules can be compared
+    without a display. Like run, this lowers experiment.number_of_blocks if the session ends early.
+
+    Parameters:
+        scheduler -- An AdaptiveScheduler.
+        observer -- A simulate.Observer, or anything with the same respond method.
+        seed -- Seed for the observer's responses.
+    """
+    experiment = scheduler.experiment
+    rng = np.random.default_rng(seed)
+    schedule = []
+
+    block_num = 0
+    while block_num < experiment.number_of_blocks:
+        for trial in scheduler.pre_block_hook(experiment, None, block_num):
+            colors = np.array([trial['color_indexes']])
+            responses = observer.respond(colors, experiment.wheel_size, rng)
+            scheduler.record(trial['set_size'], experiment.calculate_errors(colors, responses)[0].tolist())
+            schedule.append(trial['set_size'])
+        block_num += 1
+
+    return schedule
@@ -0,0 +1,338 @@
+"""Incrementally combines ResolutionWR sessions into one dataset.
+
+Every session csv in the data directory is merged with its _info.json file and saved as a part
+file. A manifest records the size, modification time and hash of every ingested file, so later runs
+only read the sessions that are new or have changed. The parts are then concatenated into one csv.
+
+Usage:
+    python aggregate.py data --output combined
+
+The output directory holds manifest.json, the parts folder, combined.csv and anomalies.csv, which
+lists problems such as responses that did not match a wheel color or duplicated subject and session
+numbers.
+
+Functions:
+file_hash -- Returns the sha1 hex digest of a file.
+find_sessions -- Finds the session csv files in a directory and their info files.
+ingest_session -- Reads one session and writes it to a part file.
+update -- Brings the combined dataset up to date with a data directory.
+write_combined -- Concatenates the part files into one csv file.
+"""
+
+
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+
+
+MANIFEST_VERSION = 1
+
+_SESSION_PATTERN = re.compile(r'^(?P<stem>(?P<experiment>.+)_(?P<subject>\d+)_(?P<session>\d+))'
+                              r'(?P<copy>\(\d+\))?\.csv$')
+
+# Data fields that are already in the csv, so they are not copied from the info file
+_INFO_DUPLICATES = ('Subject Number', 'Session')
+
+
+def _write_atomic(filename, write):
+    tmp_filename = filename + '.tmp'
+
+    with open(tmp_filename, 'w', newline='') as f:
+        write(f)
+
+    os.replace(tmp_filename, filename)
+
+
+def file_hash(filename):
+    """Returns the sha1 hex digest of a file."""
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _stat(entry):
+    stat = entry.stat()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def find_sessions(directory, experiment_name=None):
+    """
+    Finds the session csv files in a directory and their info files.
+
+    Files named <experiment>_<subject>_<session>.csv are found in directory and its subdirectories,
+    including the (n) copies made by ResolutionWR.open_csv_data_file. Returns a dict keyed by the csv
+    path with the size and modification time of the csv and its info file (None if it is missing).
+
+    Parameters:
+        directory -- The data directory.
+        experiment_name -- If given, only files of this experiment are found.
+    """
+    sessions = {}
+    stack = [directory]
+
+    while stack:
+        csv_files, other_files = {}, {}
+
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                    continue
+
+                match = _SESSION_PATTERN.match(entry.name)
+                if match and (experiment_name is None or match.group('experiment') == experiment_name):
+                    csv_files[entry.path] = (match, entry)
+                else:
+                    other_files[entry.name] = entry
+
+        for path, (match, entry) in csv_files.items():
+            # The info file is copied with the same (n) as the csv file, unless only one of them existed
+            info = (other_files.get(match.group('stem') + '_info' + (match.group('copy') or '') + '.json') or
+                    other_files.get(match.group('stem') + '_info.json'))
+
+            sessions[path] = {
+                'csv': _stat(entry),
+                'info_path': info.path if info is not None else None,
+                'info': _stat(info) if info is not None else None,
+                'subject': match.group('subject'),
+                'session': match.group('session'),
+            }
+
+    return sessions
+
+
+def ingest_session(path, info_path, part_filename):
+    """
+    Reads one session and writes it to a part file.
+
+    The info file answers are added to every row. Returns a manifest entry with the part fields and
+    row count, the csv hash and a list of anomalies found in the session.
+
+    Parameters:
+        path -- The session csv file.
+        info_path -- The session info json file, or None.
+        part_filename -- Where to write the part file.
+    """
+    anomalies = []
+
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    csv_hash = hashlib.sha1(contents).hexdigest()
+    contents = contents.decode('utf-8')
+
+    if contents and not contents.endswith('\n'):
+        anomalies.append('partially written last row')
+        contents = contents[:contents.rfind('\n') + 1]
+
+    rows = list(csv.reader(contents.splitlines()))
+    fields = rows.pop(0) if rows else []
+
+    info = {}
+    if info_path is None:
+        anomalies.append('missing info file')
+    else:
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+        except ValueError:
+            anomalies.append('unreadable info file')
+
+    info_fields = [key for key in info if key not in _INFO_DUPLICATES and key not in fields]
+    info_values = [str(info[key]) for key in info_fields]
+
+    if not rows:
+        anomalies.append('no trials')
+
+    if 'Error' in fields:
+        error = fields.index('Error')
+        missing = sum(row[error] in ('None', 'NA', '') for row in rows if len(row) > error)
+        if missing:
+            anomalies.append('{} responses without an error'.format(missing))
+
+    if any(len(row) != len(fields) for row in rows):
+        anomalies.append('rows with the wrong number of columns')
+
+    data_ids = {(row[fields.index('Subject')], row[fields.index('Session')]) for row in rows
+                if 'Subject' in fields and 'Session' in fields and len(row) == len(fields)}
+
+    def write(f):
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(fields + info_fields + ['SourceFile'])
+        writer.writerows(row + info_values + [path] for row in rows)
+
+    _write_atomic(part_filename, write)
+
+    return {
+        'hash': csv_hash,
+        'part': os.path.basename(part_filename),
+        'fields': fields + info_fields + ['SourceFile'],
+        'rows': len(rows),
+        'data_ids': sorted(data_ids),
+        'anomalies': anomalies,
+    }
+
+
+def _ingest(args):
+    return ingest_session(*args)
+
+
+def _unchanged(entry, found):
+    return entry['csv'] == found['csv'] and entry['info'] == found['info'] and entry['info_path'] == found['info_path']
+
+
+def _check_duplicates(manifest):
+    """Returns (path, anomaly) pairs for sessions that share a subject and session number."""
+    owners = {}
+
+    for path, entry in manifest.items():
+        ids = {(entry['subject'].lstrip('0') or '0', entry['session'].lstrip('0') or '0')}
+        ids.update((subject.lstrip('0') or '0', session.lstrip('0') or '0') for subject, session in entry['data_ids'])
+        for key in ids:
+            owners.setdefault(key, set()).add(path)
+
+    return [(path, 'duplicate subject {} session {}'.format(*key))
+            for key, paths in sorted(owners.items()) if len(paths) > 1 for path in sorted(paths)]
+
+
+def write_combined(manifest, output_directory, filename='combined.csv'):
+    """
+    Concatenates the part files into one csv file.
+
+    Rows of parts that have every field are copied without being parsed. Fields missing from a part
+    are written as NA.
+
+    Parameters:
+        manifest -- The sessions dict of the manifest.
+        output_directory -- The directory with the parts folder.
+        filename -- The name of the combined csv file.
+    """
+    fields = []
+    for entry in manifest.values():
+        fields.extend(field for field in entry['fields'] if field not in fields)
+
+    def write(f):
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(fields)
+
+        for path in sorted(manifest):
+            part = os.path.join(output_directory, 'parts', manifest[path]['part'])
+
+            with open(part, newline='') as part_file:
+                if manifest[path]['fields'] == fields:
+                    part_file.readline()
+                    f.writelines(part_file)
+                else:
+                    for row in csv.DictReader(part_file):
+                        writer.writerow([row.get(field, 'NA') for field in fields])
+
+    _write_atomic(os.path.join(output_directory, filename), write)
+
+
+def _load_manifest(filename):
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+
+    return manifest['sessions']
+
+
+def update(directory, output_directory, experiment_name=None, max_workers=None):
+    """
+    Brings the combined dataset up to date with a data directory.
+
+    Sessions whose csv and info files have the same size and modification time as in the manifest are
+    skipped. Changed files are hashed and only read again if the hash differs. Parts of deleted
+    sessions are removed. Returns a (manifest sessions, anomalies, number of sessions read) tuple.
+
+    Parameters:
+        directory -- The data directory.
+        output_directory -- Where the manifest, parts and combined files are saved.
+        experiment_name -- If given, only sessions of this experiment are combined.
+        max_workers -- The number of processes used to read sessions. Defaults to the number of CPUs.
+    """
+    parts_directory = os.path.join(output_directory, 'parts')
+    os.makedirs(parts_directory, exist_ok=True)
+
+    manifest_filename = os.path.join(output_directory, 'manifest.json')
+    manifest = _load_manifest(manifest_filename)
+    found = find_sessions(directory, experiment_name)
+
+    removed = set(manifest) - set(found)
+    for path in removed:
+        entry = manifest.pop(path)
+        if os.path.isfile(os.path.join(parts_directory, entry['part'])):
+            os.remove(os.path.join(parts_directory, entry['part']))
+
+    changed = []
+    for path, session in found.items():
+        entry = manifest.get(path)
+        if entry is not None and _unchanged(entry, session):
+            continue
+        if entry is not None and entry['info'] == session['info'] and entry['hash'] == file_hash(path):
+            entry.update(session)  # touched but not changed
+            continue
+        changed.append(path)
+
+    if changed:
+        jobs = [(path, found[path]['info_path'],
+                 os.path.join(parts_directory, hashlib.sha1(path.encode()).hexdigest()[:16] + '.csv'))
+                for path in changed]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            for path, entry in zip(changed, pool.map(_ingest, jobs, chunksize=16)):
+                entry.update(found[path])
+                manifest[path] = entry
+
+    anomalies = [(path, anomaly) for path in sorted(manifest) for anomaly in manifest[path]['anomalies']]
+    anomalies += _check_duplicates(manifest)
+
+    if changed or removed or not os.path.isfile(os.path.join(output_directory, 'combined.csv')):
+        write_combined(manifest, output_directory)
+
+    def write_anomalies(f):
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(['File', 'Anomaly'])
+        writer.writerows(anomalies)
+
+    _write_atomic(os.path.join(output_directory, 'anomalies.csv'), write_anomalies)
+    _write_atomic(manifest_filename, lambda f: json.dump({'version': MANIFEST_VERSION, 'sessions': manifest}, f))
+
+    return manifest, anomalies, len(changed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', help='The data directory.')
+    parser.add_argument('--output', default='combined', help='Where to save the combined dataset.')
+    parser.add_argument('--experiment', help='Only combine sessions of this experiment.')
+    parser.add_argument('--workers', type=int, help='The number of processes (default the number of CPUs).')
+    args = parser.parse_args(argv)
+
+    manifest, anomalies, n_read = update(args.directory, args.output, args.experiment, args.workers)
+
+    print('Read {} of {} sessions ({} rows)'.format(
+        n_read, len(manifest), sum(entry['rows'] for entry in manifest.values())))
+
+    if anomalies:
+        print('Found {} anomalies, see {}'.format(len(anomalies), os.path.join(args.output, 'anomalies.csv')))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""Mixture model analysis of ResolutionWR data.
+
+Fits the standard mixture model (Zhang & Luck, 2008; a guess rate plus von Mises precision) and
+the swap model (Bays, Catalao & Husain, 2009; which adds responses to non-target colors) to the
+Error column of the files written by ResolutionWR.run_trial. Models are fit separately for each
+subject and set size with a vectorized EM algorithm, and subjects are fit in parallel.
+
+Usage:
+    python analysis.py data/*.csv --output parameters.csv
+
+Functions:
+fit_files -- Fits the models to a list of data files and returns a tidy parameter table.
+fit_mixture -- Fits the mixture model to an array of errors.
+fit_swap -- Fits the swap model to arrays of errors and non-target errors.
+load_session -- Loads the columns needed for the analysis from a data file.
+trial_errors -- Arranges the errors of one set size by trial.
+write_table -- Writes a parameter table to a csv file.
+"""
+
+
+import argparse
+import concurrent.futures
+import csv
+import math
+import sys
+
+import numpy as np
+
+import datasinks
+
+
+table_fields = [
+    'Subject',
+    'Session',
+    'SetSize',
+    'Model',
+    'Responses',
+    'TargetRate',
+    'SwapRate',
+    'GuessRate',
+    'Kappa',
+    'SD',
+    'LogLikelihood',
+    'AIC',
+]
+
+_START_KAPPAS = (1, 10, 100)
+_START_TARGET_RATES = (0.9, 0.5, 0.1)
+
+
+def _to_float(values):
+    """Converts csv strings to floats, with NA, None and empty strings as NaN."""
+    return np.array([float(v) if v not in ('NA', 'None', '') else np.nan for v in values])
+
+
+def load_session(filename):
+    """
+    Loads the columns needed for the analysis from a data file.
+
+    Returns a dict with Subject and Session (strings), Block, Trial, SetSize and ColorIndex (ints)
+    and Error (floats, NaN where the response did not match a wheel color) arrays.
+
+    Parameters:
+        filename -- A csv file written by ResolutionWR, or a .npz or .parquet file written by
+            datasinks.ColumnarWriter.
+    """
+    if filename.endswith('.npz') or filename.endswith('.parquet'):
+        columns, _ = datasinks.load_columnar(filename)
+        return {
+            'Subject': columns['Subject'].astype(str),
+            'Session': columns['Session'].astype(str),
+            'Block': columns['Block'].astype(int),
+            'Trial': columns['Trial'].astype(int),
+            'SetSize': columns['SetSize'].astype(int),
+            'ColorIndex': columns['ColorIndex'].astype(int),
+            'Error': columns['Error'].astype(float),
+        }
+
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(zip(*reader))
+
+    if not rows:
+        rows = [()] * len(header)
+
+    raw = dict(zip(header, rows))
+
+    return {
+        'Subject': np.array(raw['Subject'], dtype=str),
+        'Session': np.array(raw['Session'], dtype=str),
+        'Block': np.array(raw['Block'], dtype=int),
+        'Trial': np.array(raw['Trial'], dtype=int),
+        'SetSize': np.array(raw['SetSize'], dtype=int),
+        'ColorIndex': np.array(raw['ColorIndex'], dtype=int),
+        'Error': _to_float(raw['Error']),
+    }
+
+
+def trial_errors(session, set_size, wheel_size=360):
+    """
+    Arranges the errors of one set size by trial.
+
+    Rows of a trial are written together, so trials are found as runs of rows with the same block
+    and trial number. Incomplete trials are skipped.
+
+    Returns (errors, nontarget_errors) in radians. errors has one value per response.
+    nontarget_errors has a row per response with the distance from the response to each of the other
+    colors in the trial. Responses with a missing error are removed.
+
+    Parameters:
+        session -- A dict returned by load_session.
+        set_size -- The set size to select.
+        wheel_size -- The number of colors on the color wheel used to collect the data.
+    """
+    block, trial = session['Block'], session['Trial']
+    starts = np.flatnonzero(np.r_[True, (block[1:] != block[:-1]) | (trial[1:] != trial[:-1])])
+    lengths = np.diff(np.r_[starts, block.shape[0]])
+
+    starts = starts[(session['SetSize'][starts] == set_size) & (lengths == set_size)]
+    rows = starts[:, np.newaxis] + np.arange(set_size)
+
+    colors = session['ColorIndex'][rows]
+    errors = session['Error'][rows]
+    responses = colors + errors
+
+    # Every response against every color of its trial, without the target
+    nontargets = responses[:, :, np.newaxis] - colors[:, np.newaxis, :]
+    off_diagonal = ~np.eye(set_size, dtype=bool)
+    nontargets = nontargets[:, off_diagonal].reshape(colors.size, set_size - 1)
+
+    errors = errors.reshape(-1)
+    keep = ~np.isnan(errors)
+    scale = 2 * np.pi / wheel_size
+
+    return _wrap(errors[keep] * scale), _wrap(nontargets[keep] * scale)
+
+
+def _wrap(radians):
+    """Wraps angles to -pi to pi."""
+    return (radians + np.pi) % (2 * np.pi) - np.pi
+
+
+def _log_i0(kappa):
+    """The log of the modified Bessel function of order 0, without overflowing for large kappa."""
+    if kappa < 500:
+        return math.log(np.i0(kappa))
+    return kappa - 0.5 * math.log(2 * np.pi * kappa)
+
+
+def _von_mises(radians, kappa):
+    """The von Mises density centered on 0."""
+    return np.exp(kappa * np.cos(radians) - _log_i0(kappa)) / (2 * np.pi)
+
+
+def _a1(kappa):
+    """The mean resultant length of a von Mises distribution, I1(kappa) / I0(kappa)."""
+    x = np.linspace(-np.pi, np.pi, 4096, endpoint=False)
+    weights = np.exp(kappa * (np.cos(x) - 1))
+    return float(np.dot(np.cos(x), weights) / weights.sum())
+
+
+def _a1_inverse(r):
+    """Approximates the kappa with mean resultant length r (Fisher, 1993)."""
+    if r < 0.53:
+        return 2 * r + r ** 3 + 5 * r ** 5 / 6
+    if r < 0.85:
+        return -0.4 + 1.39 * r + 0.43 / (1 - r)
+    return 1 / (r ** 3 - 4 * r ** 2 + 3 * r)
+
+
+def _em(errors, nontarget_errors, kappa, target_rate, swap_rate, max_iterations, tolerance):
+    """Runs EM from one starting point and returns (target_rate, swap_rate, kappa, log likelihood)."""
+    n_nontargets = nontarget_errors.shape[1]
+    cos_errors = np.cos(errors)
+    cos_nontargets = np.cos(nontarget_errors)
+
+    log_likelihood = -np.inf
+
+    for _ in range(max_iterations):
+        guess_rate = 1 - target_rate - swap_rate
+
+        target = target_rate * _von_mises(errors, kappa)
+        swaps = swap_rate / max(n_nontargets, 1) * _von_mises(nontarget_errors, kappa)
+        likelihood = target + swaps.sum(1) + guess_rate / (2 * np.pi)
+
+        previous, log_likelihood = log_likelihood, float(np.log(likelihood).sum())
+        if abs(log_likelihood - previous) < tolerance:
+            break
+
+        target /= likelihood
+        swaps /= likelihood[:, np.newaxis]
+
+        target_rate = float(target.mean())
+        swap_rate = float(swaps.sum(1).mean())
+
+        weight = target.sum() + swaps.sum()
+        if weight > 0:
+            r = (np.dot(target, cos_errors) + (swaps * cos_nontargets).sum()) / weight
+            kappa = _a1_inverse(min(max(float(r), 0), 1 - 1e-6))
+        else:
+            kappa = 0
+
+    return target_rate, swap_rate, kappa, log_likelihood
+
+
+def _fit(errors, nontarget_errors, swap, max_iterations, tolerance):
+    n = errors.shape[0]
+    best = None
+
+    for kappa in _START_KAPPAS:
+        for target_rate in _START_TARGET_RATES:
+            swap_rate = (1 - target_rate) / 2 if swap else 0
+            fit = _em(errors, nontarget_errors, kappa, target_rate, swap_rate, max_iterations, tolerance)
+            if best is None or fit[3] > best[3]:
+                best = fit
+
+    target_rate, swap_rate, kappa, log_likelihood = best
+    n_parameters = 3 if swap else 2
+    a1 = _a1(kappa) if n else 0
+
+    return {
+        'Responses': n,
+        'TargetRate': target_rate,
+        'SwapRate': swap_rate if swap else None,
+        'GuessRate': 1 - target_rate - swap_rate,
+        'Kappa': kappa,
+        'SD': math.degrees(math.sqrt(-2 * math.log(a1))) if a1 > 0 else math.inf,
+        'LogLikelihood': log_likelihood,
+        'AIC': 2 * n_parameters - 2 * log_likelihood,
+    }
+
+
+def fit_mixture(errors, max_iterations=5000, tolerance=1e-6):
+    """
+    Fits the mixture model to an array of errors.
+
+    Returns a dict with the target and guess rates, the concentration (Kappa) and the equivalent
+    standard deviation in degrees (SD), the log likelihood and AIC.
+
+    Parameters:
+        errors -- An array of response errors in radians.
+        max_iterations -- The maximum number of EM iterations from each starting point.
+        tolerance -- EM stops when the log likelihood changes by less than this.
+    """
+    errors = np.asarray(errors, dtype=float)
+    return _fit(errors, np.empty((errors.shape[0], 0)), False, max_iterations, tolerance)
+
+
+def fit_swap(errors, nontarget_errors, max_iterations=5000, tolerance=1e-6):
+    """
+    Fits the swap model to arrays of errors and non-target errors.
+
+    Returns the same dict as fit_mixture with the swap rate added.
+
+    Parameters:
+        errors -- An array of response errors in radians.
+        nontarget_errors -- An array with a row for each response of the distances in radians from the
+            response to each non-target color.
+        max_iterations -- The maximum number of EM iterations from each starting point.
+        tolerance -- EM stops when the log likelihood changes by less than this.
+    """
+    errors = np.asarray(errors, dtype=float)
+    return _fit(errors, np.asarray(nontarget_errors, dtype=float), True, max_iterations, tolerance)
+
+
+def _fit_group(subject, session, sessions, wheel_size):
+    """Fits every model and set size for one group of sessions and returns the table rows."""
+    rows = []
+    set_sizes = np.unique(np.concatenate([s['SetSize'] for s in sessions]))
+
+    for set_size in set_sizes.tolist():
+        errors, nontargets = zip(*[trial_errors(s, set_size, wheel_size) for s in sessions])
+        errors = np.concatenate(errors)
+        nontargets = np.concatenate(nontargets)
+
+        if not errors.shape[0]:
+            continue
+
+        fits = [('mixture', fit_mixture(errors))]
+        if set_size > 1:
+            fits.append(('swap', fit_swap(errors, nontargets)))
+
+        for model, fit in fits:
+            row = {'Subject': subject, 'Session': session, 'SetSize': set_size, 'Model': model}
+            row.update(fit)
+            rows.append(row)
+
+    return rows
+
+
+def fit_files(filenames, wheel_size=360, by_session=False, max_workers=None):
+    """
+    Fits the models to a list of data files and returns a tidy parameter table.
+
+    Files are loaded and subjects are fit on a process pool. The table is a list of dicts with the
+    keys in table_fields, one for each subject, set size and model, sorted by subject.
+
+    Parameters:
+        filenames -- A list of data files (see load_session).
+        wheel_size -- The number of colors on the color wheel used to collect the data.
+        by_session -- If True, each session is fit separately instead of pooling a subject's sessions.
+            Session is 'all' in the table otherwise.
+        max_workers -- The number of processes. Defaults to the number of CPUs.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+        groups = {}
+        for session in pool.map(load_session, filenames, chunksize=8):
+            if not session['Subject'].shape[0]:
+                continue
+            key = (str(session['Subject'][0]), str(session['Session'][0]) if by_session else 'all')
+            groups.setdefault(key, []).append(session)
+
+        futures = [pool.submit(_fit_group, subject, session, sessions, wheel_size)
+                   for (subject, session), sessions in sorted(groups.items())]
+
+        return [row for future in futures for row in future.result()]
+
+
+def write_table(rows, filename):
+    """
+    Writes a parameter table to a csv file.
+
+    Parameters:
+        rows -- A list of dicts returned by fit_files.
+        filename -- The path of the csv file.
+    """
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(table_fields)
+        writer.writerows(['NA' if row.get(field) is None else row[field] for field in table_fields] for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('filenames', nargs='+', help='csv, npz or parquet files written by ResolutionWR.')
+    parser.add_argument('--output', default='parameters.csv', help='Where to save the parameter table.')
+    parser.add_argument('--wheel-size', type=int, default=360,
+                        help='The number of colors on the color wheel (default 360).')
+    parser.add_argument('--by-session', action='store_true', help="Fit each session separately.")
+    parser.add_argument('--workers', type=int, help='The number of processes (default the number of CPUs).')
+    args = parser.parse_args(argv)
+
+    rows = fit_files(args.filenames, args.wheel_size, args.by_session, args.workers)
+    write_table(rows, args.output)
+    print('Saved {} fits to {}'.format(len(rows), args.output))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,473 @@
+"""Headless benchmarks for the ResolutionWR hot paths.
+
+The experiment is run against a stub window, monitor and mouse, and the psychopy stimuli are
+replaced by stubs, so no display is needed. Results are saved as json and can be compared
+against a stored baseline.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --baseline baseline.json --threshold 0.25
+    python benchmark.py --imports --output results.json
+
+The exit code is 1 if any benchmark is more than threshold slower than the baseline, or if the
+columnar file does not give back the exact wheel colors.
+
+Classes:
+StubMouse -- A mouse that moves to each wheel in turn and clicks on it.
+StubWindow -- A window that does nothing when flipped.
+
+Functions:
+check_columnar_colors -- Checks that the columnar file saves the exact wheel colors.
+compare -- Finds the benchmarks that are slower than a baseline.
+compare_imports -- Finds the imports that are slower than a baseline.
+import_times -- Measures how long importing a module takes in a fresh interpreter.
+run_benchmarks -- Runs every benchmark for every set size.
+"""
+
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import psychopy.event
+import psychopy.visual
+
+import datasinks
+import resolutionwr
+
+
+class StubWindow(object):
+    """A window that does nothing when flipped."""
+    def __init__(self, size=(1920, 1080), frame_period=1 / 60):
+        self.size = size
+        self.monitorFramePeriod = frame_period
+
+    def flip(self):
+        return time.perf_counter()
+
+    def getActualFrameRate(self, **kwargs):
+        return 1 / self.monitorFramePeriod
+
+    def _getFrame(self, rect=None, buffer='front'):
+        if rect is None:
+            width, height = self.size
+        else:
+            width = max(1, int(round((rect[2] - rect[0]) / 2 * self.size[0])))
+            height = max(1, int(round((rect[1] - rect[3]) / 2 * self.size[1])))
+        return np.full((height, width, 3), 128, dtype=np.uint8)
+
+
+class StubMonitor(object):
+    """A monitor with fixed dimensions, used for unit conversions."""
+    def getWidth(self):
+        return 53
+
+    def getDistance(self):
+        return resolutionwr.monitor_distance
+
+    def getSizePix(self):
+        return [1920, 1080]
+
+
+class StubMouse(object):
+    """
+    A mouse that moves to each wheel in turn and clicks on it.
+
+    Parameters:
+    coordinates -- A list of (x, y) wheel positions.
+    radius -- How far from each wheel center the mouse hovers.
+    frames_per_wheel -- The number of frames the mouse hovers before clicking.
+    """
+    def __init__(self, coordinates, radius, frames_per_wheel=30):
+        self.coordinates = list(coordinates)
+        self.radius = radius
+        self.frames_per_wheel = frames_per_wheel
+        self.frame = 0
+
+    def _target(self):
+        return min(self.frame // self.frames_per_wheel, len(self.coordinates) - 1)
+
+    def setVisible(self, visible):
+        pass
+
+    def clickReset(self):
+        self.frame = 0
+
+    def getPressed(self, getTime=False):
+        click = self.frame % self.frames_per_wheel == self.frames_per_wheel - 1
+        return (int(click), 0, 0), (self.frame / 60, 0, 0)
+
+    def getPos(self):
+        x, y = self.coordinates[self._target()]
+        angle = self.frame * 0.1
+        self.frame += 1
+        return np.array([x + self.radius * math.sin(angle), y + self.radius * math.cos(angle)])
+
+
+class _NullStim(object):
+    def __init__(self, win, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def draw(self):
+        pass
+
+
+@contextlib.contextmanager
+def stub_psychopy():
+    """Replaces the psychopy stimuli and keyboard functions used by ResolutionWR with stubs."""
+    replaced = [(psychopy.visual, name) for name in ('RadialStim', 'Circle', 'BufferImageStim')
+                if hasattr(psychopy.visual, name)]
+    replaced += [(psychopy.event, 'getKeys'), (psychopy.event, 'clearEvents')]
+    originals = [(module, name, getattr(module, name)) for module, name in replaced]
+
+    stubs = {'getKeys': lambda *args, **kwargs: [], 'clearEvents': lambda *args, **kwargs: None}
+
+    try:
+        for module, name in replaced:
+            setattr(module, name, stubs.get(name, _NullStim))
+        yield
+    finally:
+        for module, name, original in originals:
+            setattr(module, name, original)
+
+
+def make_experiment(**kwargs):
+    """Creates a ResolutionWR connected to a stub window."""
+    kwargs.setdefault('colorwheel_path', os.path.join(
+        os.path.dirname(os.path.abspath(resolutionwr.__file__)), resolutionwr.colorwheel_path))
+
+    exp = resolutionwr.ResolutionWR(
+        experiment_name='Benchmark', data_fields=resolutionwr.data_fields, seed=0, **kwargs)
+    exp.experiment_window = StubWindow()
+    exp.experiment_monitor = StubMonitor()
+    return exp
+
+
+def time_call(func, min_time=0.2, max_calls=100000):
+    """
+    Calls func repeatedly and returns the per call latencies in seconds.
+
+    Parameters:
+        func -- A function that takes no arguments.
+        min_time -- Calls are repeated until this many seconds have passed.
+        max_calls -- The maximum number of calls.
+    """
+    latencies = []
+    end = time.perf_counter() + min_time
+
+    while len(latencies) < max_calls and (len(latencies) < 5 or time.perf_counter() < end):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    return np.array(latencies)
+
+
+def _summarize(latencies):
+    latencies = np.asarray(latencies)
+    return {
+        'mean': float(latencies.mean()),
+        'median': float(np.median(latencies)),
+        'p95': float(np.percentile(latencies, 95)),
+        'per_second': float(1 / latencies.mean()),
+        'samples': int(latencies.shape[0]),
+    }
+
+
+def _response_loop_latencies(exp, trial, repeats):
+    latencies = []
+    ring = exp.stim_size * 0.85
+
+    for _ in range(repeats):
+        exp.mouse = StubMouse(trial['locations'], ring)
+        start = time.perf_counter()
+        exp._response_loop(trial['locations'], trial['wheel_rotations'])
+        latencies.append((time.perf_counter() - start) / exp.mouse.frame)
+
+    return latencies
+
+
+def benchmark_set_size(set_size, min_time=0.2):
+    """
+    Runs every benchmark for one set size.
+
+    Parameters:
+        set_size -- The number of items in each trial.
+        min_time -- The minimum number of seconds spent on each benchmark.
+    """
+    exp = make_experiment(set_sizes=[set_size])
+    trial = exp.make_trial(set_size)
+    locations, rotations = trial['locations'], trial['wheel_rotations']
+    hover = np.array(locations[0]) + [0, exp.stim_size * 0.85]
+    resp_color = exp.color_wheel[(trial['color_indexes'][0] + 10) % exp.wheel_size]
+
+    exp.build_color_wheels(locations, rotations)
+
+    results = {
+        'make_block': time_call(exp.make_block, min_time),
+        'generate_color_indexes': time_call(lambda: exp.generate_color_indexes(set_size), min_time),
+        'draw_color_wheels': time_call(exp.draw_color_wheels, min_time),
+        'calc_mouse_color_analytic': time_call(lambda: exp._calc_mouse_color(hover, 0), min_time),
+        'response_geometry_hit': time_call(lambda: exp.response_geometry.hit(hover), min_time),
+        'calculate_error': time_call(
+            lambda: exp.calculate_error(trial['color_indexes'][0], resp_color), min_time),
+    }
+
+    exp.color_lookup = 'pixel'
+    results['calc_mouse_color_pixel'] = time_call(lambda: exp._calc_mouse_color(hover, 0), min_time)
+    exp.color_lookup = 'analytic'
+
+    results = {name: _summarize(latencies) for name, latencies in results.items()}
+    results['response_loop_iteration'] = _summarize(_response_loop_latencies(exp, trial, 5))
+
+    return results
+
+
+def run_benchmarks(set_sizes=range(1, 13), min_time=0.2):
+    """
+    Runs every benchmark for every set size.
+
+    Returns a dict with the environment and the results keyed by benchmark name and set size.
+
+    Parameters:
+        set_sizes -- The set sizes to benchmark.
+        min_time -- The minimum number of seconds spent on each benchmark.
+    """
+    results = {}
+
+    with stub_psychopy():
+        for set_size in set_sizes:
+            for name, summary in benchmark_set_size(set_size, min_time).items():
+                results.setdefault(name, {})[str(set_size)] = summary
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def check_columnar_colors():
+    """
+    Checks that the columnar file saves the exact wheel colors.
+
+    One response to every wheel entry is saved through datasinks.ColumnarWriter and loaded again
+    with datasinks.load_columnar, for both color lookups. Returns a list of the columns that differ
+    from color_wheel_rgb, which is empty if every color came back exactly.
+    """
+    exp = make_experiment()
+    exp.experiment_info = {'Subject Number': '1', 'Session': 1}
+    indexes = list(range(exp.wheel_size))
+    trial = {
+        'set_size': exp.wheel_size,
+        'locations': [(0, 0)] * exp.wheel_size,
+        'color_indexes': indexes,
+        'color_values': list(exp.color_wheel),
+    }
+    # Pixel lookup reads uint8 values and has no index
+    pixels = [np.array(rgb, dtype=np.uint8) for rgb in exp.color_wheel_rgb.tolist()]
+    lookups = {
+        'analytic': (list(exp.color_wheel_rgb), indexes),
+        'pixel': (pixels, [None] * exp.wheel_size),
+    }
+
+    mismatches = []
+    with tempfile.TemporaryDirectory() as directory, stub_psychopy():
+        for lookup, (colors, resp_indexes) in lookups.items():
+            responses = (colors, [0.0] * exp.wheel_size, indexes, resp_indexes)
+            data = exp._trial_data(trial, 0, 0, responses, (None, None), None)
+
+            filename = os.path.join(directory, lookup + '.npz')
+            writer = datasinks.ColumnarWriter(filename, exp.data_fields)
+            writer.write(data)
+            writer.save()
+            columns, _ = datasinks.load_columnar(filename)
+
+            for field in ('TrueColor', 'RespColor'):
+                rgb = np.stack([columns[field + channel] for channel in 'RGB'], axis=1)
+                if rgb.dtype != np.uint8 or not np.array_equal(rgb, exp.color_wheel_rgb):
+                    mismatches.append('{} ({})'.format(field, lookup))
+
+    return mismatches
+
+
+def import_times(module='resolutionwr', repeats=5):
+    """
+    Measures how long importing a module takes in a fresh interpreter.
+
+    Uses python -X importtime. Returns a dict with the total import time of module and the time of
+    each module it imports directly, in seconds. The fastest of repeats runs is kept for each, so
+    the results do not depend on the disk cache.
+
+    Parameters:
+        module -- The name of the module to import.
+        repeats -- The number of interpreters to start.
+    """
+    times = {}
+
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                 cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE,
+                                 universal_newlines=True, check=True)
+
+        # Modules are listed after the modules they import, so the direct imports of module are the
+        # top level entries between the previous top level module and module itself
+        children = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            name, seconds = name.strip(), int(cumulative) / 1e6
+
+            if depth == 1:
+                children[name] = seconds
+            elif depth == 0 and name != module:
+                children = {}
+            elif depth == 0:
+                children[name] = seconds
+                for child, seconds in children.items():
+                    times[child] = min(times.get(child, math.inf), seconds)
+
+    return {
+        'module': module,
+        'total': times.pop(module),
+        'modules': times,
+    }
+
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Finds the benchmarks that are slower than a baseline.
+
+    Returns a list of (name, set_size, baseline mean, new mean) tuples for every benchmark whose
+    mean latency is more than threshold (as a fraction) slower than the baseline.
+
+    Parameters:
+        results -- A dict returned by run_benchmarks.
+        baseline -- A dict returned by run_benchmarks.
+        threshold -- The allowed fractional slowdown.
+    """
+    regressions = []
+
+    for name, set_sizes in results['results'].items():
+        for set_size, summary in set_sizes.items():
+            try:
+                old = baseline['results'][name][set_size]['mean']
+            except KeyError:
+                continue
+            if summary['mean'] > old * (1 + threshold):
+                regressions.append((name, set_size, old, summary['mean']))
+
+    return regressions
+
+
+def compare_imports(imports, baseline, threshold=0.25, min_time=0.01):
+    """
+    Finds the imports that are slower than a baseline.
+
+    Returns a list of (module, baseline time, new time) tuples for the total and for every directly
+    imported module that took at least min_time seconds and is more than threshold slower than the baseline.
+
+    Parameters:
+        imports -- A dict returned by import_times.
+        baseline -- A dict returned by import_times.
+        threshold -- The allowed fractional slowdown.
+        min_time -- Modules faster than this many seconds in both are not compared, as they are mostly noise.
+    """
+    regressions = []
+
+    if imports['total'] > baseline['total'] * (1 + threshold):
+        regressions.append((imports['module'], baseline['total'], imports['total']))
+
+    for name, seconds in imports['modules'].items():
+        old = baseline['modules'].get(name, 0)
+        if max(old, seconds) >= min_time and seconds > old * (1 + threshold):
+            regressions.append((name, old, seconds))
+
+    return regressions
+
+
+def print_results(results):
+    """Prints the mean latency of every benchmark in microseconds."""
+    names = sorted(results['results'])
+    set_sizes = list(results['results'][names[0]])
+
+    print('{:<28}'.format('us per call') + ''.join('{:>10}'.format(s) for s in set_sizes))
+    for name in names:
+        means = [results['results'][name][s]['mean'] * 1e6 for s in set_sizes]
+        print('{:<28}'.format(name) + ''.join('{:>10.1f}'.format(m) for m in means))
+
+
+def print_imports(imports, count=10):
+    """Prints the total import time and the slowest directly imported modules in milliseconds."""
+    print('import {}: {:.1f}ms'.format(imports['module'], imports['total'] * 1e3))
+
+    slowest = sorted(imports['modules'].items(), key=lambda item: item[1], reverse=True)[:count]
+    for name, seconds in slowest:
+        print('  {:<26}{:>10.1f}'.format(name, seconds * 1e3))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='Where to save the results as json.')
+    parser.add_argument('--baseline', help='A results file to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown compared to the baseline as a fraction (default 0.25).')
+    parser.add_argument('--set-sizes', type=int, nargs='+', default=list(range(1, 13)))
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimum number of seconds spent on each benchmark (default 0.2).')
+    parser.add_argument('--imports', action='store_true',
+                        help='Also measure the time it takes to import resolutionwr.')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.set_sizes, args.min_time)
+    print_results(results)
+
+    mismatches = check_columnar_colors()
+    for column in mismatches:
+        print('MISMATCH columnar {} differs from the wheel colors'.format(column))
+
+    if args.imports:
+        results['imports'] = import_times()
+        print_imports(results['imports'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+
+        for name, set_size, old, new in regressions:
+            print('REGRESSION {} (set size {}): {:.1f}us -> {:.1f}us'.format(name, set_size, old * 1e6, new * 1e6))
+
+        if 'imports' in results and 'imports' in baseline:
+            import_regressions = compare_imports(results['imports'], baseline['imports'], args.threshold)
+            for name, old, new in import_regressions:
+                print('REGRESSION import {}: {:.1f}ms -> {:.1f}ms'.format(name, old * 1e3, new * 1e3))
+            regressions += import_regressions
+
+        if regressions:
+            return 1
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,537 @@
+"""Data sinks used by ResolutionWR to save trial data while the experiment is running.
+
+Classes:
+ColumnarWriter -- Saves rows as typed columns in a npz or parquet file.
+NetworkSink -- Sends rows to a collection server through a local spool.
+StreamingCsvWriter -- Appends rows to a csv file from a background thread.
+
+Functions:
+load_columnar -- Loads a file written by ColumnarWriter.
+repair_csv_file -- Removes a partially written last row from a csv file.
+"""
+
+
+import csv
+import gzip
+import json
+import numbers
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+_FLUSH = object()
+_TIMEOUT = object()
+
+
+def _format_row(row, fields):
+    """Formats a row dict the same way template.BaseExperiment.save_data_to_csv does."""
+    return [str(row[field]).replace('"', "'") if field in row else 'NA' for field in fields]
+
+
+def repair_csv_file(filename, output=None):
+    """
+    Removes a partially written last row from a csv file.
+
+    A crash while a row is being written leaves a last line without a newline, which is cut off
+    so that the file can be read again. Returns the number of bytes that were removed.
+
+    Parameters:
+        filename -- The path of the csv file.
+        output -- If set, the repaired file is written to this path instead and filename is left
+            unchanged. Nothing is written if there is no partial row.
+    """
+    with open(filename, 'rb' if output is not None else 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+        if size == 0:
+            return 0
+
+        # Read backwards until the last complete line is found
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            chunk = f.read(end - start)
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+
+        if end != size:
+            if output is None:
+                f.truncate(end)
+            else:
+                f.seek(0)
+                with open(output, 'wb') as out:
+                    remaining = end
+                    while remaining:
+                        chunk = f.read(min(remaining, 1 << 20))
+                        out.write(chunk)
+                        remaining -= len(chunk)
+
+    return size - end
+
+
+class StreamingCsvWriter(object):
+    """
+    Appends rows to a csv file from a background thread.
+
+    Rows are put on a queue by write, which never blocks on file I/O. The background thread
+    writes them with the csv module, flushes the file every flush_interval seconds and fsyncs
+    it every fsync_interval seconds, so at most a few seconds of data can be lost in a crash.
+
+    Parameters:
+    filename -- The path of the csv file. Rows are appended if it already exists.
+    fields -- The list of column names.
+    flush_interval -- The maximum number of seconds between flushes.
+    fsync_interval -- The maximum number of seconds between fsyncs. None never fsyncs.
+    write_header -- If True, the header is written before any rows.
+
+    Methods:
+    close -- Writes all remaining rows and stops the background thread.
+    flush -- Blocks until every queued row has been written and flushed.
+    write -- Queues a list of row dicts to be written.
+    """
+    def __init__(self, filename, fields, flush_interval=1, fsync_interval=5, write_header=True):
+        self.filename = filename
+        self.fields = list(fields)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+
+        self._queue = queue.Queue()
+        self._error = None
+        self._closed = False
+        self._dirty = False
+        self._last_flush = self._last_fsync = time.monotonic()
+
+        self._file = open(filename, 'a', newline='')
+        self._writer = csv.writer(self._file, quoting=csv.QUOTE_ALL, lineterminator='\n')
+
+        if write_header:
+            self._writer.writerow(self.fields)
+            self._file.flush()
+
+        self._thread = threading.Thread(target=self._run, name='StreamingCsvWriter', daemon=True)
+        self._thread.start()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, rows):
+        """
+        Queues a list of row dicts to be written.
+
+        Parameters:
+            rows -- A list of dicts where keys exist in fields. Missing fields are written as NA.
+        """
+        self._check_error()
+
+        if self._closed:
+            raise ValueError('write to closed StreamingCsvWriter')
+
+        self._queue.put(list(rows))
+
+    def flush(self):
+        """Blocks until every queued row has been written and flushed."""
+        self._queue.put(_FLUSH)
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """Writes all remaining rows and stops the background thread."""
+        if self._closed:
+            return
+
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self._check_error()
+
+    def _maybe_sync(self, forced):
+        """Flushes and fsyncs the file if one is due. Closing and explicit flushes always do both."""
+        if not (self._dirty or forced):
+            return
+
+        now = time.monotonic()
+        fsync = self.fsync_interval is not None and (forced or now - self._last_fsync >= self.fsync_interval)
+
+        if forced or fsync or now - self._last_flush >= self.flush_interval:
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+            self._last_flush = now
+            self._dirty = False
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = _TIMEOUT
+
+            try:
+                if isinstance(item, list):
+                    self._writer.writerows(_format_row(row, self.fields) for row in item)
+                    self._dirty = True
+
+                self._maybe_sync(forced=item is None or item is _FLUSH)
+            except Exception as e:  # raised on the next call from the experiment thread
+                self._error = e
+
+            if item is not _TIMEOUT:
+                self._queue.task_done()
+
+            if item is None:
+                return
+
+
+def _is_rgb(value):
+    return isinstance(value, (list, tuple, np.ndarray)) and len(value) == 3
+
+
+def _to_column(values, exact_rgb=None):
+    """
+    Converts a list of values into typed numpy columns.
+
+    Returns a list of (suffix, array) pairs. Ints become int64 columns, other numbers float64
+    columns, and None becomes NaN in numeric columns. -1 to 1 rgb triplets are split into
+    R, G and B uint8 (0 to 255) columns. Anything else is saved as strings.
+
+    Parameters:
+        values -- The list of values of one field.
+        exact_rgb -- An optional list of the exact 0 to 255 values of rgb triplets, used instead of
+            converting the rounded -1 to 1 values back where they are not None.
+    """
+    present = [v for v in values if v is not None]
+
+    if present and all(_is_rgb(v) for v in present):
+        rgb = np.array([v if v is not None else [np.nan] * 3 for v in values], dtype=float)
+        rgb = np.rint((rgb + 1) * 127.5)
+        if exact_rgb is not None:
+            for i, exact in enumerate(exact_rgb):
+                if exact is not None and values[i] is not None:
+                    rgb[i] = exact
+        if np.isnan(rgb).any():
+            return [(channel, rgb[:, i]) for i, channel in enumerate('RGB')]
+        return [(channel, rgb[:, i].astype(np.uint8)) for i, channel in enumerate('RGB')]
+
+    if present and all(isinstance(v, numbers.Real) and not isinstance(v, bool) for v in present):
+        if len(present) == len(values) and all(isinstance(v, numbers.Integral) for v in present):
+            return [('', np.array(values, dtype=np.int64))]
+        return [('', np.array([np.nan if v is None else v for v in values], dtype=float))]
+
+    return [('', np.array(['' if v is None else str(v) for v in values]))]
+
+
+class ColumnarWriter(object):
+    """
+    Saves rows as typed columns in a npz or parquet file.
+
+    Rows are collected in memory and the whole file is rewritten by save, so the file always
+    holds every row sent so far. The experiment info is stored with the columns. Parquet files
+    need pyarrow.
+
+    -1 to 1 rgb fields are saved as R, G and B columns of 0 to 255 values. The -1 to 1 values are
+    rounded, so if a row also has a field name + 'RGB' key (e.g. 'TrueColorRGB') with the exact
+    0 to 255 values, those are saved instead.
+
+    Parameters:
+    filename -- The path of the output file.
+    fields -- The list of column names.
+    file_format -- Either 'npz' or 'parquet'.
+    info -- A json serializable dict saved as metadata (e.g. the experiment info).
+
+    Methods:
+    columns -- Returns the typed columns for all rows collected so far.
+    save -- Writes all rows collected so far.
+    write -- Adds a list of row dicts.
+    """
+    formats = ('npz', 'parquet')
+
+    def __init__(self, filename, fields, file_format='npz', info=None):
+        if file_format not in self.formats:
+            raise ValueError('file_format must be one of ' + ', '.join(self.formats))
+
+        if file_format == 'parquet':
+            import pyarrow  # noqa: F401 -- fail now instead of at the end of the first block
+
+        self.filename = filename
+        self.fields = list(fields)
+        self.file_format = file_format
+        self.info = info if info is not None else {}
+
+        self._columns = {field: [] for field in self.fields}
+        self._exact_rgb = {field: [] for field in self.fields}
+
+    def write(self, rows):
+        """
+        Adds a list of row dicts.
+
+        Parameters:
+            rows -- A list of dicts where keys exist in fields. Missing fields are saved as None.
+        """
+        for row in rows:
+            for field in self.fields:
+                self._columns[field].append(row.get(field))
+                self._exact_rgb[field].append(row.get(field + 'RGB'))
+
+    def columns(self):
+        """Returns the typed columns for all rows collected so far as a dict of numpy arrays."""
+        columns = {}
+
+        for field in self.fields:
+            exact_rgb = self._exact_rgb[field]
+            if all(exact is None for exact in exact_rgb):
+                exact_rgb = None
+
+            for suffix, array in _to_column(self._columns[field], exact_rgb):
+                columns[field + suffix] = array
+
+        return columns
+
+    def save(self):
+        """Writes all rows collected so far."""
+        columns = self.columns()
+        info = json.dumps(self.info, default=str)
+        tmp_filename = self.filename + '.tmp'
+
+        if self.file_format == 'npz':
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, __info__=np.array(info), **columns)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+
+            table = pyarrow.table(columns).replace_schema_metadata({'info': info})
+            pyarrow.parquet.write_table(table, tmp_filename)
+
+        os.replace(tmp_filename, self.filename)
+
+
+def load_columnar(filename):
+    """
+    Loads a file written by ColumnarWriter.
+
+    Returns a (columns, info) tuple where columns is a dict of numpy arrays. Parquet files are
+    memory mapped.
+
+    Parameters:
+        filename -- The path of a .npz or .parquet file.
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.read_table(filename, memory_map=True)
+        info = json.loads(table.schema.metadata[b'info'])
+        columns = {name: table.column(name).to_numpy() for name in table.column_names}
+    else:
+        with np.load(filename) as data:
+            info = json.loads(str(data['__info__']))
+            columns = {name: data[name] for name in data.files if name != '__info__'}
+
+    return columns, info
+
+
+class NetworkSink(object):
+    """
+    Sends rows to a collection server through a local spool.
+
+    Rows are collected into batches by a background thread. Each batch is gzip compressed and saved
+    in the spool directory before it is sent, and is only deleted once the server has stored it. A
+    second thread sends the spooled batches and keeps retrying while the server can not be reached,
+    so write never waits for the network and no rows are lost. Batches left in the spool by an
+    earlier session are sent as well. See wrserver.py for the server.
+
+    Parameters:
+    url -- The address of the server, e.g. 'http://192.168.1.10:8000'.
+    fields -- The list of column names.
+    source -- The name of the data file the rows belong to, used by the server to name its files.
+    station -- The name of this computer. Defaults to the host name.
+    spool_directory -- Where batches are saved until they have been sent.
+    batch_interval -- The maximum number of seconds rows wait before they are spooled.
+    retry_interval -- The number of seconds between attempts when the server can not be reached.
+    timeout -- The number of seconds to wait for the server to reply.
+    close_timeout -- How long close keeps trying to send the spool before leaving it for the next session.
+
+    Methods:
+    close -- Spools the remaining rows, tries to send the spool and stops the background threads.
+    pending -- Returns the number of spooled batches that have not been sent.
+    spool -- Blocks until every written row has been saved in the spool.
+    write -- Queues a list of row dicts to be sent.
+    """
+    def __init__(self, url, fields, source, station=None, spool_directory='spool', batch_interval=1,
+                 retry_interval=5, timeout=5, close_timeout=5):
+        self.url = url.rstrip('/') + '/batches'
+        self.fields = list(fields)
+        self.source = source
+        self.station = station if station is not None else socket.gethostname()
+        self.spool_directory = spool_directory
+        self.batch_interval = batch_interval
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.close_timeout = close_timeout
+
+        os.makedirs(spool_directory, exist_ok=True)
+
+        self._queue = queue.Queue()
+        self._error = None
+        self._closed = False
+        self._spooled = threading.Event()
+        self._stop_sending = None  # set to a deadline by close
+
+        self._spooler = threading.Thread(target=self._run_spooler, name='NetworkSinkSpooler', daemon=True)
+        self._sender = threading.Thread(target=self._run_sender, name='NetworkSinkSender', daemon=True)
+        self._spooler.start()
+        self._sender.start()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, rows):
+        """
+        Queues a list of row dicts to be sent.
+
+        Parameters:
+            rows -- A list of dicts where keys exist in fields. Missing fields are sent as NA.
+        """
+        self._check_error()
+
+        if self._closed:
+            raise ValueError('write to closed NetworkSink')
+
+        self._queue.put(list(rows))
+
+    def spool(self):
+        """Blocks until every written row has been saved in the spool. Does not wait for the network."""
+        self._queue.put(_FLUSH)
+        self._queue.join()
+        self._check_error()
+
+    def pending(self):
+        """Returns the number of spooled batches that have not been sent."""
+        return len(self._spool_files())
+
+    def close(self):
+        """Spools the remaining rows, tries to send the spool and stops the background threads."""
+        if self._closed:
+            return
+
+        self._closed = True
+        self._queue.put(None)
+        self._spooler.join()
+
+        self._stop_sending = time.monotonic() + self.close_timeout
+        self._spooled.set()
+        self._sender.join()
+        self._check_error()
+
+    def _spool_files(self):
+        return sorted(name for name in os.listdir(self.spool_directory) if name.endswith('.json.gz'))
+
+    def _save_batch(self, rows):
+        batch_id = uuid.uuid4().hex
+        batch = {'id': batch_id, 'station': self.station, 'source': self.source, 'fields': self.fields,
+                 'rows': rows}
+
+        # The time in the name keeps the batches in order
+        filename = os.path.join(self.spool_directory, '{:020d}-{}.json.gz'.format(time.time_ns(), batch_id))
+
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(gzip.compress(json.dumps(batch).encode('utf-8')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+
+        self._spooled.set()
+
+    def _run_spooler(self):
+        rows = []
+        last_spool = time.monotonic()
+
+        while True:
+            try:
+                item = self._queue.get(timeout=self.batch_interval)
+            except queue.Empty:
+                item = _TIMEOUT
+
+            try:
+                if isinstance(item, list):
+                    rows.extend(_format_row(row, self.fields) for row in item)
+
+                forced = item is None or item is _FLUSH
+                if rows and (forced or time.monotonic() - last_spool >= self.batch_interval):
+                    self._save_batch(rows)
+                    rows = []
+                    last_spool = time.monotonic()
+            except Exception as e:  # raised on the next call from the experiment thread
+                self._error = e
+
+            if item is not _TIMEOUT:
+                self._queue.task_done()
+
+            if item is None:
+                return
+
+    def _send(self, filename):
+        """Sends one spooled batch. Returns False if the server could not be reached."""
+        # Imported here because urllib.request (and ssl) slow down starting the experiment
+        import http.client
+        import urllib.error
+        import urllib.request
+
+        path = os.path.join(self.spool_directory, filename)
+
+        with open(path, 'rb') as f:
+            body = f.read()
+
+        request = urllib.request.Request(self.url, data=body, method='POST', headers={
+            'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500:
+                # The server will never accept it, so keep it for inspection without blocking the rest
+                os.replace(path, path + '.rejected')
+                return True
+            return False
+        except (OSError, ValueError, http.client.HTTPException):
+            # e.g. the connection was closed before the whole reply was read
+            return False
+
+        os.remove(path)
+        return True
+
+    def _run_sender(self):
+        while True:
+            # Only stop after a pass that started once the last batch was spooled
+            closing = self._stop_sending is not None
+
+            for filename in self._spool_files():
+                if not self._send(filename):
+                    break
+            else:
+                if closing:
+                    return
+
+            if closing and time.monotonic() >= self._stop_sending:
+                return
+
+            if not closing:
+                self._spooled.wait(self.retry_interval)
+                self._spooled.clear()
+            else:
+                time.sleep(min(self.retry_interval, max(0, self._stop_sending - time.monotonic())))
@@ -0,0 +1,270 @@
+"""Live summaries of a running ResolutionWR session.
+
+Every trial updates a few running sums per set size, so the summary costs the same however long the
+session has run. The summary can be shown on the break screen or written to a small json status file
+that a monitoring script polls.
+
+Classes:
+LiveStats -- Keeps running error, guess rate and rt summaries for each set size.
+P2Quantile -- Estimates a quantile of a stream of values with the P-square algorithm.
+"""
+
+
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+
+class P2Quantile(object):
+    """
+    Estimates a quantile of a stream of values with the P-square algorithm (Jain & Chlamtac, 1985).
+
+    Only five markers are kept, so adding a value takes constant time and memory. The estimate is
+    exact until five values have been added.
+
+    Parameters:
+    q -- The quantile, from 0 to 1.
+
+    Methods:
+    add -- Adds a value.
+    value -- Returns the current estimate, or None if no values were added.
+    """
+    def __init__(self, q):
+        if not 0 < q < 1:
+            raise ValueError('q must be between 0 and 1.')
+
+        self.q = q
+        self.count = 0
+        self._heights = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0, 2 * q, 4 * q, 2 + 2 * q, 4]
+        self._increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    def add(self, x):
+        """
+        Adds a value.
+
+        Parameters:
+            x -- A number.
+        """
+        self.count += 1
+        heights = self._heights
+
+        if self.count <= 5:
+            heights.append(x)
+            heights.sort()
+            return
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+
+        positions = self._positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        for i in (1, 2, 3):
+            d = self._desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    def _parabolic(self, i, d):
+        h, n = self._heights, self._positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        """Returns the current estimate, or None if no values were added."""
+        if not self.count:
+            return None
+        if self.count <= 5:
+            return float(np.percentile(self._heights, self.q * 100))
+        return float(self._heights[2])
+
+
+def _a1(kappa):
+    """The mean resultant length of a von Mises distribution, I1(kappa) / I0(kappa)."""
+    x = np.linspace(-np.pi, np.pi, 1024, endpoint=False)
+    weights = np.exp(kappa * (np.cos(x) - 1))
+    return float(np.dot(np.cos(x), weights) / weights.sum())
+
+
+def _guess_rate(mean_cos, mean_cos2):
+    """
+    Estimates the guess rate of a von Mises plus uniform mixture from its first two trigonometric moments.
+
+    The moments are (1 - g) A1(kappa) and (1 - g) A2(kappa), with A2(kappa) = 1 - 2 A1(kappa) / kappa,
+    so their ratio only depends on kappa, which is found by bisection.
+    """
+    if mean_cos <= 0:
+        return 1.0
+
+    ratio = mean_cos2 / mean_cos
+    if ratio <= 0:
+        return 1.0
+
+    low, high = math.log(1e-3), math.log(1e3)
+    for _ in range(30):
+        kappa = math.exp((low + high) / 2)
+        a1 = _a1(kappa)
+        if (1 - 2 * a1 / kappa) / a1 < ratio:
+            low = math.log(kappa)
+        else:
+            high = math.log(kappa)
+
+    return min(max(1 - mean_cos / _a1(math.exp((low + high) / 2)), 0.0), 1.0)
+
+
+class _SetSizeStats(object):
+    def __init__(self, quantiles):
+        self.trials = 0
+        self.responses = 0
+        self.missing = 0
+        self.abs_error = 0.0
+        self.cos = 0.0
+        self.cos2 = 0.0
+        self.guess_rate = None  # Cached until the next response
+        self.rt = [P2Quantile(q / 100) for q in quantiles]
+
+
+class LiveStats(object):
+    """
+    Keeps running error, guess rate and rt summaries for each set size.
+
+    For each set size the summary has the mean absolute error in degrees, a guess rate estimated from
+    the first two trigonometric moments of the errors (a quick approximation of the mixture model fit by
+    analysis.py), and rt quantiles from P2Quantile sketches. Updating takes constant time per response,
+    and the guess rate of a set size is only estimated again after it has new responses.
+
+    Parameters:
+    wheel_size -- The number of colors on the color wheel, used to convert errors to degrees.
+    quantiles -- The rt percentiles to estimate.
+
+    Methods:
+    format -- Returns the summary as lines of text for the break screen.
+    save -- Writes the summary to a json status file.
+    summary -- Returns the current summary of each set size.
+    update -- Adds the rows of a trial.
+    """
+    def __init__(self, wheel_size, quantiles=(50, 90)):
+        self.wheel_size = wheel_size
+        self.quantiles = tuple(quantiles)
+        self.trials = 0
+        self._stats = {}
+
+    def update(self, rows):
+        """
+        Adds the rows of a trial.
+
+        Parameters:
+            rows -- A list of row dicts, as returned by ResolutionWR.run_trial. Rows without an error
+                are counted as missing.
+        """
+        self.trials += 1
+        counted = set()
+
+        for row in rows:
+            set_size = row['SetSize']
+            stats = self._stats.get(set_size)
+            if stats is None:
+                stats = self._stats[set_size] = _SetSizeStats(self.quantiles)
+
+            if set_size not in counted:
+                stats.trials += 1
+                counted.add(set_size)
+
+            rt = row.get('RT')
+            if rt is not None:
+                for sketch in stats.rt:
+                    sketch.add(rt)
+
+            if row.get('Error') is None:
+                stats.missing += 1
+                continue
+
+            radians = 2 * math.pi * row['Error'] / self.wheel_size
+            stats.responses += 1
+            stats.abs_error += abs(radians)
+            stats.cos += math.cos(radians)
+            stats.cos2 += math.cos(2 * radians)
+            stats.guess_rate = None
+
+    def summary(self):
+        """
+        Returns the current summary of each set size.
+
+        Returns a dict keyed by set size with the number of trials, responses and responses without an
+        error, the mean absolute error in degrees, the estimated guess rate and the rt percentiles.
+        """
+        summary = {}
+
+        for set_size in sorted(self._stats):
+            stats = self._stats[set_size]
+            n = stats.responses
+
+            if n and stats.guess_rate is None:
+                stats.guess_rate = _guess_rate(stats.cos / n, stats.cos2 / n)
+
+            summary[set_size] = {
+                'Trials': stats.trials,
+                'Responses': n,
+                'Missing': stats.missing,
+                'MeanAbsError': math.degrees(stats.abs_error / n) if n else None,
+                'GuessRate': stats.guess_rate,
+                'RT': {str(q): sketch.value() for q, sketch in zip(self.quantiles, stats.rt)},
+            }
+
+        return summary
+
+    def format(self):
+        """Returns the summary as lines of text for the break screen."""
+        lines = []
+
+        for set_size, stats in self.summary().items():
+            if stats['Responses']:
+                rts = ', '.join('{}%: {:.2f}s'.format(q, rt) for q, rt in stats['RT'].items() if rt is not None)
+                lines.append('Set size {}: error {:.0f} deg, guessing {:.0%}, rt {}'.format(
+                    set_size, stats['MeanAbsError'], stats['GuessRate'], rts))
+            else:
+                lines.append('Set size {}: no responses'.format(set_size))
+
+        return lines
+
+    def save(self, filename, **info):
+        """
+        Writes the summary to a json status file.
+
+        The file is replaced atomically, so a script polling it never reads a partial file.
+
+        Parameters:
+            filename -- The path of the json file.
+            info -- Other json serializable values to include (e.g. the subject and block).
+        """
+        status = {'updated': time.time(), 'trials': self.trials}
+        status.update(info)
+        status['set_sizes'] = {str(set_size): stats for set_size, stats in self.summary().items()}
+
+        tmp_filename = filename + '.tmp'
+
+        with open(tmp_filename, 'w') as f:
+            json.dump(status, f, indent=2)
+
+        os.replace(tmp_filename, filename)
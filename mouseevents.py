@@ -0,0 +1,126 @@
+"""Event driven mouse input for ResolutionWR.
+
+Classes:
+MouseEvent -- A timestamped mouse event.
+MouseEventQueue -- Collects timestamped mouse events from a pyglet window.
+"""
+
+
+import collections
+import time
+
+
+LEFT_BUTTON = 1  # pyglet.window.mouse.LEFT
+
+MouseEvent = collections.namedtuple('MouseEvent', ['time', 'kind', 'pos', 'button'])
+MouseEvent.__doc__ = """
+A timestamped mouse event.
+
+time -- When the event was received, from the clock of the MouseEventQueue.
+kind -- 'press' or 'motion'.
+pos -- The (x, y) position in pixels from the center of the window, with y increasing upwards.
+button -- The pyglet button constant for presses, 0 for motion.
+"""
+
+
+class MouseEventQueue(object):
+    """
+    Collects timestamped mouse events from a pyglet window.
+
+    Handlers for mouse presses and motion are pushed onto the window's event stack, so every
+    press is recorded even if the button is released before the next frame. Events are
+    timestamped when pyglet dispatches them, which happens when the window is flipped and
+    whenever poll or wait is called, so waiting with wait instead of flipping gives timestamps
+    accurate to about a millisecond.
+
+    Parameters:
+    window -- A psychopy window using the pyglet backend.
+    clock -- A function returning the current time in seconds.
+
+    Methods:
+    clear -- Removes all queued events.
+    close -- Removes the handlers from the window.
+    get -- Returns and removes all queued events.
+    poll -- Dispatches pending window events, adding any mouse events to the queue.
+    supported -- Returns True if events can be collected from the window.
+    wait -- Waits until there are queued events or timeout seconds have passed.
+    """
+    def __init__(self, window, clock=time.perf_counter):
+        if not self.supported(window):
+            raise ValueError('MouseEventQueue needs a window using the pyglet backend.')
+
+        self.window = window
+        self.clock = clock
+        self.events = collections.deque()
+
+        # pyglet reports positions in points, which are not pixels on high dpi displays
+        self._scale = window.size[0] / window.winHandle.width
+
+        self._handlers = {
+            'on_mouse_press': self._on_press,
+            'on_mouse_motion': self._on_motion,
+            'on_mouse_drag': self._on_drag,
+        }
+        window.winHandle.push_handlers(**self._handlers)
+
+    @staticmethod
+    def supported(window):
+        """
+        Returns True if events can be collected from the window.
+
+        Parameters:
+            window -- A psychopy window.
+        """
+        return (getattr(window, 'winType', None) == 'pyglet' and
+                hasattr(getattr(window, 'winHandle', None), 'push_handlers'))
+
+    def _add(self, kind, x, y, button=0):
+        width, height = self.window.size
+        pos = (x * self._scale - width / 2, y * self._scale - height / 2)
+        self.events.append(MouseEvent(self.clock(), kind, pos, button))
+
+    def _on_press(self, x, y, button, modifiers):
+        self._add('press', x, y, button)
+
+    def _on_motion(self, x, y, dx, dy):
+        self._add('motion', x, y)
+
+    def _on_drag(self, x, y, dx, dy, buttons, modifiers):
+        self._add('motion', x, y)
+
+    def poll(self):
+        """Dispatches pending window events, adding any mouse events to the queue."""
+        self.window.winHandle.dispatch_events()
+
+    def wait(self, timeout, interval=0.0005):
+        """
+        Waits until there are queued events or timeout seconds have passed.
+
+        Sleeps between polls instead of spinning. Returns True if there are queued events.
+
+        Parameters:
+            timeout -- The maximum number of seconds to wait.
+            interval -- The number of seconds to sleep between polls.
+        """
+        end = time.perf_counter() + timeout
+
+        self.poll()
+        while not self.events and time.perf_counter() < end:
+            time.sleep(interval)
+            self.poll()
+
+        return bool(self.events)
+
+    def get(self):
+        """Returns and removes all queued events."""
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def clear(self):
+        """Removes all queued events."""
+        self.events.clear()
+
+    def close(self):
+        """Removes the handlers from the window."""
+        self.window.winHandle.remove_handlers(**self._handlers)
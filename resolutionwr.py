@@ -20,20 +20,34 @@ ResolutionWR -- The class that runs the experiment.
 """
 
 
-import copy
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import errno
 import json
 import math
 import os
-import random
 import sys
 
 import numpy as np
 
-import psychopy
+import psychopy.core
+import psychopy.event
+import psychopy.gui
+import psychopy.logging
+import psychopy.tools.monitorunittools
+import psychopy.visual
 
 import template as template
 
+import datasinks
+import livestats
+import mouseevents
+import schedules
+import timing
+import wrcore
+
 # Things you probably want to change
 set_sizes = [1, 2, 4, 6]
 trials_per_set_size = 5  # per block
@@ -65,10 +79,32 @@ instruct_text = [
 
 # Things you probably don't need to change, but can if you want to
 colorwheel_path = 'colors.json'
+wheel_size = None  # number of colors on the wheel, None uses the length of the color wheel file
 
 distance_from_fixation = 6  # visual degrees
 stim_size = 1.5  # visual degrees
-min_color_dist = 25  # should be > 360 / max(set_sizes)
+min_color_dist = 25  # degrees, max(set_sizes) * min_color_dist must be <= 360
+color_lookup = 'analytic'  # 'analytic' computes the hovered color from geometry, 'pixel' reads the screen
+nearest_color_fallback = False  # match responses to the closest wheel color if there is no exact match
+seed = None  # set to an int to make the generated trials reproducible
+schedule_path = None  # a schedule file written by schedules.py, None generates the trials at startup
+response_mode = 'events'  # 'events' collects timestamped mouse events from the window, 'polling' polls each frame
+
+stream_data = True  # write each trial to the csv from a background thread instead of at the end of a block
+flush_interval = 1  # seconds
+fsync_interval = 5  # seconds
+binary_format = None  # 'npz' or 'parquet' to also save the session as typed columns
+data_server = None  # e.g. 'http://192.168.1.10:8000' to also send every trial to a wrserver.py server
+station_name = None  # name of this computer on the data server, None uses the host name
+
+frame_locked = False  # show the timed displays for a counted number of frames instead of sleeping
+cache_response_display = False  # draw the remaining wheels from one cached image during the response phase
+record_frame_times = False  # adds frame_timing_fields to the data and saves a _timing.json file
+long_frame_threshold = None  # seconds, defaults to 1.5 frames
+profile_phases = False  # time the phases of every trial and save a _profile.json report
+profile_trials = []  # (block, trial) pairs to also run under cProfile, implies profile_phases
+break_stats = False  # show each set size's error, guess rate and rts on the break screen
+status_path = None  # e.g. 'status.json' to write the same live stats to a json file after every trial
 
 data_fields = [
     'Subject',
@@ -86,6 +122,19 @@ data_fields = [
     'RespColor',
     'Error',
     'RT',
+    'StimulusDuration',
+    'RetentionDuration',
+]
+
+# Added to data_fields if record_frame_times is True
+frame_timing_fields = [
+    'SampleOnset',
+    'SampleOffset',
+    'SampleDuration',
+    'DelayDuration',
+    'ResponseOnset',
+    'LongFrames',
+    'MaxFrameInterval',
 ]
 
 gender_options = [
@@ -123,73 +172,221 @@ questionaire_dict = {
 # Change anything below this comment at your own risk
 psychopy.logging.console.setLevel(psychopy.logging.CRITICAL)  # Avoid error output
 
+_NO_PHASE = contextlib.nullcontext()  # Used instead of timing a phase when profiling is off
+
 
-class ResolutionWR(template.BaseExperiment):
+class ResolutionWR(wrcore.TrialGenerator, template.BaseExperiment):
     """
     The class that runs the whole report estimation experiment.
 
+    Trial generation and error calculation are inherited from wrcore.TrialGenerator, which does not
+    need a display and is shared with the simulations in simulate.py.
+
     Parameters:
+    binary_format -- If 'npz' or 'parquet', the session is also saved as a typed columnar file next to the
+        csv file, with the exact 0 to 255 wheel and response colors as integer columns and the experiment info
+        as metadata.
+    break_stats -- If True, the break screen shows the mean absolute error, an estimated guess rate and rt
+        percentiles of each set size so far (see livestats.LiveStats), for the experimenter to check.
+    cache_response_display -- If True, the remaining color wheels are rendered into one BufferImageStim when
+        the response phase starts and after each click, and each frame draws that image instead of every wheel,
+        so the cost of a frame does not depend on the set size.
+    color_lookup -- How the color under the mouse is found. 'analytic' calculates it from the wheel
+        geometry and rotation, so the exact wheel entry is recorded. 'pixel' reads back a small region of the
+        screen around the mouse and matches its color, so entries with the same color give the first one.
     colorwheel_path -- A string or Path describing the location of a json file containing
-        a 360 length array of length 3 rgb arrays.
+        an array of length 3 rgb arrays (0 to 255). The converted wheel is cached in a .npy file next to it.
     data_directory -- Where the data should be saved.
+    data_server -- The address of a collection server (see wrserver.py) that every trial is also sent to.
+        Rows are batched, compressed and kept in a spool folder in the data directory until the server has
+        stored them, so the experiment never waits for the network. None disables it.
     delay_time -- The number of seconds between the stimuli display and test.
     distance_from_fixation -- A number describing how far from fixation stimuli will
         appear in visual degrees.
+    flush_interval -- When streaming data, the maximum number of seconds before written rows are flushed.
+    frame_locked -- If True, the blank and stimuli displays are shown for a number of frames calculated
+        from the measured refresh rate instead of sleeping with core.wait. Either way, the stimulus and
+        delay durations measured between the flips that started and ended them are saved in the
+        StimulusDuration and RetentionDuration columns.
+    fsync_interval -- When streaming data, the maximum number of seconds before written rows are
+        synced to disk. None never syncs.
     instruct_text -- The text to be displayed to the participant at the beginning of the experiment.
     iti_time -- The number of seconds in between a response and the next trial.
+    long_frame_threshold -- When recording frame times, frames longer than this many seconds are counted
+        as long frames. Defaults to 1.5 times the frame period of the window.
     min_color_dist -- The minimum number of degrees in color space between display items.
+    nearest_color_fallback -- If True, response colors that do not exactly match a color wheel entry
+        (e.g. because of gamma or dithering) are matched to the closest entry instead of giving no error.
     number_of_blocks -- The number of blocks in the experiment.
+    profile_phases -- If True, the iti, sample, delay, response_setup, response_loop and data phases of
+        every trial, and send_data and save_data, are timed into histograms (see timing.PhaseProfiler),
+        and a report is saved to a _profile.json file next to the csv file.
+    profile_trials -- A list of (block_num, trial_num) pairs to run under cProfile. The slowest functions
+        of each are added to the profile report. Turns on profile_phases.
     questionaire_dict -- Questions to be included in the dialog.
+    record_frame_times -- If True, the time of every flip is recorded. The stimulus onset and offset times
+        and the number of long frames of each trial are added to the data (see frame_timing_fields), and a
+        histogram of the frame intervals is saved to a _timing.json file next to the csv file. Only intervals
+        where a flip every frame is expected are scored, so waits between trials, the sleeping displays when
+        frame_locked is False and the redraws on mouse motion in 'events' response mode are left out.
+    response_mode -- How responses are collected. 'events' records timestamped mouse press and motion
+        events from the window, so brief clicks are not missed, and only redraws when the mouse moves.
+        'polling' reads the mouse state every frame, which needs the button held until the next frame.
+        'events' falls back to 'polling' if the window does not use the pyglet backend.
     sample_time -- The number of seconds the stimuli are on the screen for.
+    schedule_path -- A schedule file written by schedules.py. The file is memory mapped and the blocks of
+        the subject and session entered in the dialog are run from it instead of generating trials.
+        number_of_blocks is taken from the file. None generates the trials when the experiment starts.
+    seed -- Seed for the random number generator used to create trials. None gives a new
+        sequence every time.
     set_sizes -- A list of all the set sizes.
         An equal number of trials will be shown for each set size.
+    station_name -- The name of this computer on the data server. Defaults to the host name.
+    status_path -- A json file the live stats shown by break_stats are written to after every trial, for a
+        monitoring script to poll. It is replaced atomically. None does not write it.
     stim_size -- The size of the stimuli in visual degrees.
+    stream_data -- If True, every trial is written to the csv file by a background thread as soon as it
+        is sent, so a crash or quit only loses the last few seconds. If False, data is saved after each block.
     trials_per_set_size -- The number of trials per set size per block.
+    wheel_size -- The number of colors on the color wheel. Color indexes, rotations and errors are in
+        units of wheel entries. If it differs from the length of the color wheel file, the wheel is resampled.
+        Defaults to the length of the file. With color_lookup 'pixel', every color of a wheel with a set
+        wheel_size has to be different, otherwise a ValueError is raised.
 
     Methods:
+    add_idle_task -- Queues work to be done while waiting during a timed display.
+    build_color_wheels -- Creates the cached color wheel stimuli for the response phase.
+    cache_color_wheels -- Renders the remaining color wheels into one image.
     calculate_locations -- Calculates locations for the upcoming trial with random jitter.
     calculate_error -- Calculates error in a response compared to the true color value.
+    calculate_errors -- Calculates the errors for arrays of true and response color indexes.
     chdir -- Changes the directory to where the data will be saved.
+    color_to_index -- Finds the color wheel index of an rgb color.
+    distinct_colors -- Returns the number of different colors on the color wheel.
     display_blank -- Displays a blank screen.
     display_break -- Displays a screen during the break between blocks.
     display_stimuli -- Displays the stimuli.
-    draw_color_wheels -- Draws color wheels at stimuli locations with random rotation.
+    draw_color_wheels -- Draws the cached color wheels.
+    expand_block -- Converts an array of trial records into a list of trial dictionaries.
+    expand_trial -- Converts a trial record into the trial dictionary used by run_trial and the hooks.
     generate_color_indexes -- Generates colors for a trial given the minimum distance.
     get_response -- Manages getting responses for all color wheels.
     make_block -- Creates a list of trials to be run.
+    make_session -- Creates the blocks for a whole session.
+    make_session_records -- Creates the blocks for a whole session as arrays of trial records.
     make_trial -- Creates a single trial dictionary.
+    make_trials -- Creates a list of trial dictionaries for one set size.
+    prefetch_color_wheels -- Prepares the color wheels while another display is shown.
+    prefetch_stimuli -- Prepares the stimuli while another display is shown.
+    prepare -- Starts making the session in the background while the dialog is open.
+    open_window -- Opens the window and starts recording frame times if requested.
+    quit_experiment -- Closes the data files and quits the experiment.
     run -- Runs the entire experiment including optional hooks.
     run_trial -- Runs a single trial.
+    save_data_to_csv -- Makes sure all sent data is in the csv file.
+    scheduled_session -- Returns the blocks of a subject and session from the schedule file.
     send_data -- Updates the experiment data with the information from the last trial.
+    trial_arrays -- Generates the random values for a number of trials of one set size.
+    trial_records -- Generates an array of trial records for one set size.
     """
     def __init__(self, set_sizes=set_sizes, trials_per_set_size=trials_per_set_size,
                  number_of_blocks=number_of_blocks, distance_from_fixation=distance_from_fixation,
                  min_color_dist=min_color_dist, colorwheel_path=colorwheel_path, stim_size=stim_size,
                  iti_time=iti_time, sample_time=sample_time, delay_time=delay_time,
                  data_directory=data_directory, questionaire_dict=questionaire_dict,
-                 instruct_text=instruct_text, **kwargs):
-
-        self.set_sizes = set_sizes
-        self.trials_per_set_size = trials_per_set_size
-        self.number_of_blocks = number_of_blocks
+                 instruct_text=instruct_text, color_lookup=color_lookup,
+                 nearest_color_fallback=nearest_color_fallback, seed=seed, stream_data=stream_data,
+                 flush_interval=flush_interval, fsync_interval=fsync_interval, binary_format=binary_format,
+                 record_frame_times=record_frame_times, long_frame_threshold=long_frame_threshold,
+                 frame_locked=frame_locked, wheel_size=wheel_size, response_mode=response_mode,
+                 data_server=data_server, station_name=station_name,
+                 cache_response_display=cache_response_display, schedule_path=schedule_path,
+                 profile_phases=profile_phases, profile_trials=profile_trials, break_stats=break_stats,
+                 status_path=status_path, **kwargs):
+
+        if response_mode not in ('events', 'polling'):
+            raise ValueError("response_mode must be 'events' or 'polling'.")
+
+        if color_lookup not in ('analytic', 'pixel'):
+            raise ValueError("color_lookup must be 'analytic' or 'pixel'.")
 
-        self.distance_from_fixation = distance_from_fixation
         self.stim_size = stim_size
 
         self.questionaire_dict = questionaire_dict
         self.data_directory = data_directory
         self.instruct_text = instruct_text
 
-        self.min_color_dist = min_color_dist
+        self.color_lookup = color_lookup
 
         self.iti_time = iti_time
         self.sample_time = sample_time
         self.delay_time = delay_time
 
-        self.color_wheel = self._load_color_wheel(colorwheel_path)
+        self.wheel_texture = None
+        self.wheel_stims = {}
+        self.response_geometry = None
         self.mouse = None
-
-        super().__init__(**kwargs)
+        self.response_mode = response_mode
+        self.mouse_events = None
+
+        self.session = None
+        self.schedule_path = schedule_path
+        self.schedule = None
+        self.schedule_info = None
+
+        self.stream_data = stream_data
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.data_writer = None
+        self.binary_format = binary_format
+        self.columnar_writer = None
+        self.data_server = data_server
+        self.station_name = station_name
+        self.network_sink = None
+
+        self.record_frame_times = record_frame_times
+        self.long_frame_threshold = long_frame_threshold
+        self.frame_timer = None
+
+        self.profiler = None
+        if profile_phases or profile_trials:
+            self.profiler = timing.PhaseProfiler(profile_trials)
+
+        self.frame_locked = frame_locked
+        self.frame_period = None
+        self.idle_tasks = collections.deque()
+        self._worker = None
+        self._preparation = None
+        self._response_onset = None
+
+        self.sample_stims = []
+        self._sample_stims_for = None
+        self._wheel_stims_for = None
+
+        self.cache_response_display = cache_response_display
+        self.response_display = None
+        self.preview_stim = None
+
+        super().__init__(set_sizes=set_sizes, trials_per_set_size=trials_per_set_size,
+                         number_of_blocks=number_of_blocks, distance_from_fixation=distance_from_fixation,
+                         min_color_dist=min_color_dist, colorwheel_path=colorwheel_path, wheel_size=wheel_size,
+                         nearest_color_fallback=nearest_color_fallback, seed=seed,
+                         convert_color_value=template.convert_color_value, **kwargs)
+
+        if color_lookup == 'pixel' and wheel_size is not None and self.distinct_colors() < self.wheel_size:
+            raise ValueError(
+                'Only {} of the {} colors of the color wheel are different, so pixel color lookup can not tell '
+                "them apart. Use color_lookup='analytic' or a smaller wheel_size.".format(
+                    self.distinct_colors(), self.wheel_size))
+
+        if self.record_frame_times:
+            self.data_fields = self.data_fields + frame_timing_fields
+
+        self.break_stats = break_stats
+        self.status_path = status_path
+        self.live_stats = None
+        if break_stats or status_path is not None:
+            self.live_stats = livestats.LiveStats(self.wheel_size)
 
     def save_experiment_info(self, filename=None):
         """Writes the info from the dialog box to a json file.
@@ -231,6 +428,11 @@ class ResolutionWR(template.BaseExperiment):
         """Opens the csv file and writes the header.
 
         This method overwrites the base method in order to include the session number in the filename.
+        If the file already exists and is kept, a copy without a partially written last row left by
+        a crash is saved (see _check_existing_data_file).
+        If self.stream_data is True, the file is kept open by a datasinks.StreamingCsvWriter.
+        If self.binary_format is set, a datasinks.ColumnarWriter is opened with the same filename.
+        If self.data_server is set, a datasinks.NetworkSink is opened to send the rows to the server.
 
         Parameters:
             data_filename -- name of the csv file with no extension
@@ -245,28 +447,145 @@ class ResolutionWR(template.BaseExperiment):
             data_filename = data_filename[:-4]
 
         if os.path.isfile(data_filename + '.csv'):
-            if self.overwrite_ok is None:
-                self.overwrite_ok = self._confirm_overwrite()
-            if not self.overwrite_ok:
-                # If the file exists and we can't overwrite make a new filename
-                i = 1
-                new_filename = data_filename + '(' + str(i) + ')'
-                while os.path.isfile(new_filename + '.csv'):
-                    i += 1
-                    new_filename = data_filename + '(' + str(i) + ')'
-                data_filename = new_filename
+            data_filename = self._check_existing_data_file(data_filename)
 
         self.experiment_data_filename = data_filename + '.csv'
 
         # Write the header
-        with open(self.experiment_data_filename, 'w+') as data_file:
-            for field in self.data_fields:
-                data_file.write('"')
-                data_file.write(field)
-                data_file.write('"')
-                if field != self.data_fields[-1]:
-                    data_file.write(',')
-            data_file.write('\n')
+        with open(self.experiment_data_filename, 'w', newline='') as data_file:
+            csv.writer(data_file, quoting=csv.QUOTE_ALL, lineterminator='\n').writerow(self.data_fields)
+
+        if self.stream_data:
+            self.data_writer = datasinks.StreamingCsvWriter(
+                self.experiment_data_filename, self.data_fields, flush_interval=self.flush_interval,
+                fsync_interval=self.fsync_interval, write_header=False)
+
+        if self.binary_format is not None:
+            self.columnar_writer = datasinks.ColumnarWriter(
+                data_filename + '.' + self.binary_format, self.data_fields, self.binary_format,
+                info=self.experiment_info)
+
+        if self.data_server is not None:
+            self.network_sink = datasinks.NetworkSink(
+                self.data_server, self.data_fields, source=os.path.basename(self.experiment_data_filename),
+                station=self.station_name,
+                spool_directory=os.path.join(os.path.dirname(self.experiment_data_filename), 'spool'))
+
+    def _check_existing_data_file(self, data_filename):
+        """
+        Returns the filename to use instead of an existing csv file.
+
+        If the file can't be overwritten, a new filename is returned and the existing file is left
+        unchanged. If its last row was only partially written by a crash, a repaired copy without
+        that row is saved next to it as filename_repaired.csv.
+
+        Parameters:
+            data_filename -- name of the existing csv file with no extension
+        """
+        if self.overwrite_ok is None:
+            self.overwrite_ok = self._confirm_overwrite()
+        if not self.overwrite_ok:
+            repaired_filename = data_filename + '_repaired.csv'
+            if datasinks.repair_csv_file(data_filename + '.csv', output=repaired_filename):
+                print('Saved ' + data_filename + '.csv without its partially written last row as ' +
+                      repaired_filename)
+
+            # If the file exists and we can't overwrite make a new filename
+            i = 1
+            new_filename = data_filename + '(' + str(i) + ')'
+            while os.path.isfile(new_filename + '.csv'):
+                i += 1
+                new_filename = data_filename + '(' + str(i) + ')'
+            data_filename = new_filename
+
+        return data_filename
+
+    def open_window(self, **kwargs):
+        """Opens the window and starts recording frame times if self.record_frame_times is True.
+
+        If self.frame_locked is True, the refresh rate is measured.
+
+        Parameters:
+            kwargs -- Sent to template.BaseExperiment.open_window().
+        """
+        super().open_window(**kwargs)
+
+        self.frame_period = self.experiment_window.monitorFramePeriod
+
+        if self.frame_locked:
+            frame_rate = self.experiment_window.getActualFrameRate()
+            if frame_rate is not None:
+                self.frame_period = 1 / frame_rate
+            else:
+                print('Could not measure the refresh rate, using ' + str(1 / self.frame_period) + 'Hz.')
+
+        if self.record_frame_times:
+            self.frame_timer = timing.FrameTimer(self.frame_period, threshold=self.long_frame_threshold)
+
+    def _flip(self):
+        """Flips the window and returns the time of the flip.
+
+        The time is recorded if frame times are being recorded.
+        """
+        flip_time = self.experiment_window.flip()
+
+        if flip_time is None:
+            flip_time = psychopy.core.getTime()
+
+        if self.frame_timer is not None:
+            self.frame_timer.record(flip_time)
+
+        return flip_time
+
+    def _frame_gap(self):
+        """Marks a pause in flipping, so the interval before the next flip is not counted as a long frame."""
+        if self.frame_timer is not None:
+            self.frame_timer.mark_gap()
+
+    def _flip_count(self):
+        """Returns the number of recorded flips, or None if frame times are not being recorded."""
+        if self.frame_timer is None:
+            return None
+        return self.frame_timer.count
+
+    def _frame_timing_data(self, first_flip, sample_flip, delay_flip, response_flip):
+        """
+        Calculates the frame_timing_fields for a trial from the indexes of its flips.
+
+        Parameters:
+            first_flip -- The index of the first flip of the trial.
+            sample_flip -- The index of the flip that showed the stimuli.
+            delay_flip -- The index of the flip that removed the stimuli.
+            response_flip -- The index of the flip that showed the color wheels.
+        """
+        times = self.frame_timer.times
+        intervals = self.frame_timer.intervals(first_flip)
+
+        return {
+            'SampleOnset': times[sample_flip],
+            'SampleOffset': times[delay_flip],
+            'SampleDuration': times[delay_flip] - times[sample_flip],
+            'DelayDuration': times[response_flip] - times[delay_flip],
+            'ResponseOnset': times[response_flip],
+            'LongFrames': self.frame_timer.long_frames(first_flip).shape[0],
+            'MaxFrameInterval': intervals.max() if intervals.shape[0] else None,
+        }
+
+    def _save_frame_timing(self):
+        """Saves the frame interval summary next to the csv file."""
+        if self.frame_timer is not None:
+            self.frame_timer.save(self.experiment_data_filename[:-4] + '_timing.json')
+
+    def _phase(self, name):
+        """Returns a context manager that times a phase, or does nothing if profiling is off."""
+        if self.profiler is None:
+            return _NO_PHASE
+        return self.profiler.phase(name)
+
+    def _save_profile(self):
+        """Saves the phase profile report next to the csv file."""
+        if self.profiler is not None:
+            self.profiler.save(self.experiment_data_filename[:-4] + '_profile.json')
 
     def chdir(self):
         """Changes the directory to where the data will be saved."""
@@ -278,166 +597,361 @@ class ResolutionWR(template.BaseExperiment):
 
         os.chdir(self.data_directory)
 
-    def _load_color_wheel(self, path):
+    def add_idle_task(self, task):
         """
-        Loads the json color wheel file.
+        Queues work to be done while waiting during a timed display.
+
+        Tasks are run in order whenever display_blank or display_stimuli have time to spare.
 
         Parameters:
-            path -- Str or Path of the json file.
+            task -- A function that takes no arguments, or a generator. Generators are advanced one
+                step at a time, so long work can be split into small slices with yield.
         """
-        with open(path) as f:
-            color_wheel = json.load(f)
-
-        color_wheel = [template.convert_color_value(i) for i in color_wheel]
+        self.idle_tasks.append(task)
 
-        return np.array(color_wheel)
+    def _run_idle_tasks(self, deadline):
+        """
+        Runs queued idle tasks until they are done or the deadline has passed.
 
-    def calculate_locations(self, set_size):
+        Parameters:
+            deadline -- A time from psychopy.core.getTime() after which no new work is started.
+        """
+        while self.idle_tasks and psychopy.core.getTime() < deadline:
+            task = self.idle_tasks[0]
+
+            if callable(task):
+                self.idle_tasks.popleft()
+                task()
+            else:
+                try:
+                    next(task)
+                except StopIteration:
+                    self.idle_tasks.popleft()
+
+    def _present(self, stims, duration):
         """
-        Calculates locations for the upcoming trial with random jitter.
+        Shows stimuli for a number of seconds and returns the time of the flip that showed them.
+
+        The display ends with the first flip of whatever is shown next, so the duration that was
+        achieved is the onset of the next display minus the returned time.
+
+        If self.frame_locked is True, the duration is converted to a number of frames and the
+        stimuli are flipped that many times. Otherwise the stimuli are flipped once and the
+        remaining time is waited out. Idle tasks are run in the spare time either way.
 
         Parameters:
-            set_size -- The number of locations to return.
+            stims -- A list of stimuli to draw.
+            duration -- The number of seconds to show the stimuli for.
         """
-        angle_dist = 360 / set_size
-        rotation = random.randint(0, angle_dist - 1)
-        angles = [int(i * angle_dist + rotation + random.randint(-5, 5)) for i in range(set_size)]
+        if not self.frame_locked:
+            for stim in stims:
+                stim.draw()
+
+            onset = self._flip()
+            self._run_idle_tasks(onset + duration)
+            psychopy.core.wait(max(0, onset + duration - psychopy.core.getTime()))
+            self._frame_gap()
+
+            return onset
 
-        locations = [(self.distance_from_fixation * math.cos(math.radians(i)),
-                      self.distance_from_fixation * math.sin(math.radians(i)))
-                     for i in angles]
+        n_frames = max(1, int(round(duration / self.frame_period)))
 
-        return locations
+        for frame in range(n_frames):
+            for stim in stims:
+                stim.draw()
 
-    def _check_dist(self, attempt, colors):
+            flip_time = self._flip()
+            if frame == 0:
+                onset = flip_time
+
+            # Leave half of the frame to draw and flip the next one
+            self._run_idle_tasks(flip_time + self.frame_period / 2)
+
+        return onset
+
+    def display_blank(self, wait_time):
         """
-        Checks if a color attempt statistfies the distance condition.
+        Displays a blank screen.
+
+        Returns the time of the flip that showed the blank.
 
         Parameters:
-            attempt -- The color index to be checked.
-            colors -- The list of color indexes to be checked against.
+            wait_time -- The number of seconds to display the blank for.
         """
-        for c in colors:
-            raw_dist = abs(c - attempt)
-            dist = min(raw_dist, 360 - raw_dist)
+        return self._present([], wait_time)
 
-            if dist < self.min_color_dist:
-                return False
+    def _build_stimuli(self, coordinates, colors):
+        """Creates the stimuli one at a time, yielding after each one."""
+        self.sample_stims = []
+        self._sample_stims_for = None
 
-        return True
+        for pos, color in zip(coordinates, colors):
+            self.sample_stims.append(psychopy.visual.Circle(
+                self.experiment_window, radius=self.stim_size, pos=pos, fillColor=color,
+                units='deg', lineColor=None))
+            yield
 
-    def generate_color_indexes(self, set_size):
+        self._sample_stims_for = coordinates
+
+    def prefetch_stimuli(self, coordinates, colors):
         """
-        Generates colors for a trial given the minimum distance.
+        Prepares the stimuli while another display is shown.
+
+        The stimuli are created as idle tasks, one per frame slice, and are used by display_stimuli
+        if it is called with the same coordinates list.
 
         Parameters:
-            set_size -- The number of colors to generate.
+            coordinates -- A list of (x, y) tuples in visual degrees.
+            colors -- A list of -1 to 1 rgb color lists
         """
-        colors = []
+        self.add_idle_task(self._build_stimuli(coordinates, colors))
 
-        while len(colors) < set_size:
-            attempt = random.randint(0, 359)
-            if self._check_dist(attempt, colors):
-                colors.append(attempt)
+    def display_stimuli(self, coordinates, colors):
+        """
+        Displays the stimuli.
 
-        return colors
+        Returns the time of the flip that showed the stimuli.
 
-    def make_trial(self, set_size):
+        Parameters:
+            coordinates -- A list of (x, y) tuples in visual degrees.
+            colors -- A list of -1 to 1 rgb color lists
         """
-        Creates a single trial dictionary.
+        self._run_idle_tasks(math.inf)  # Finish prefetching that did not fit in the previous display
 
-        Parameters:
-            set_size -- The number of items to be displayed.
-        """
-        color_indexes = self.generate_color_indexes(set_size)
-        color_values = [self.color_wheel[i] for i in color_indexes]
-        wheel_rotations = [random.randint(0, 359) for _ in range(set_size)]
-        locations = self.calculate_locations(set_size)
-
-        trial = {
-            'set_size': set_size,
-            'color_indexes': color_indexes,
-            'color_values': color_values,
-            'wheel_rotations': wheel_rotations,
-            'locations': locations
-        }
+        if self._sample_stims_for is not coordinates:
+            for _ in self._build_stimuli(coordinates, colors):
+                pass
 
-        return trial
+        self._sample_stims_for = None
 
-    def make_block(self):
-        """Makes a block of trials.
+        return self._present(self.sample_stims, self.sample_time)
 
-        Returns a shuffled list of trials created by self.make_trial.
-        """
+    def _make_wheel_texture(self):
+        """Builds the color wheel texture that is shared by every wheel stimulus."""
+        return np.repeat(self.color_wheel[np.newaxis, :, :], 360, 0)
+
+    def _make_wheel_mask(self):
+        """Builds the radial mask that only shows the outer 30% of each wheel."""
+        mask = np.zeros([100, 1])
+        mask[-30:] = 1
+        return mask
 
-        trial_list = []
+    def _build_color_wheels(self, coordinates, wheel_rotations):
+        """Creates the response geometry and then the color wheel stimuli one at a time, yielding after each one."""
+        if self.wheel_texture is None:
+            self.wheel_texture = self._make_wheel_texture()
 
-        for set_size in self.set_sizes:
-            for _ in range(self.trials_per_set_size):
-                trial = self.make_trial(set_size)
-                trial_list.append(trial)
+        mask = self._make_wheel_mask()
 
-        random.shuffle(trial_list)
+        self.wheel_stims = {}
+        self.response_display = None
+        self._wheel_stims_for = None
 
-        return trial_list
+        # The mask rows go from the center to the edge of the wheel
+        self.response_geometry = wrcore.ResponseGeometry(
+            coordinates, wheel_rotations, outer_radius=self.stim_size,
+            inner_radius=self.stim_size * (1 - mask.mean()), wheel_size=self.wheel_size)
 
-    def display_blank(self, wait_time):
+        for i, (pos, rot) in enumerate(zip(coordinates, wheel_rotations)):
+            self.wheel_stims[i] = psychopy.visual.RadialStim(
+                self.experiment_window, tex=self.wheel_texture, mask=mask, pos=pos,
+                ori=rot * 360 / self.wheel_size,
+                angularRes=256, angularCycles=1, interpolate=False, size=self.stim_size * 2)
+            yield
+
+        self._wheel_stims_for = (coordinates, wheel_rotations)
+
+    def build_color_wheels(self, coordinates, wheel_rotations):
         """
-        Displays a blank screen.
+        Creates the color wheel stimuli for the upcoming response phase.
+
+        The wheels are cached in self.wheel_stims (keyed by location number) so that they only
+        have to be created once per trial, and self.response_geometry is created for finding the
+        wheel and color under the mouse. Rotation is handled with the orientation of the stimulus,
+        so every wheel shares the same texture.
 
         Parameters:
-            wait_time -- The number of seconds to display the blank for.
+            coordinates -- A list of (x, y) tuples
+            wheel_rotations -- A list of ints (0 to wheel_size - 1) describing how much each wheel
+                should be rotated.
         """
-        self.experiment_window.flip()
+        for _ in self._build_color_wheels(coordinates, wheel_rotations):
+            pass
+
+    def _prefetch_color_wheels(self, coordinates, wheel_rotations):
+        if self.wheel_texture is None:
+            # The texture is plain numpy, so it can be built off the drawing thread
+            if self._worker is None:
+                self._worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+            texture = self._worker.submit(self._make_wheel_texture)
+            while not texture.done():
+                yield
+            self.wheel_texture = texture.result()
+
+        yield from self._build_color_wheels(coordinates, wheel_rotations)
+
+    def _load_schedule(self):
+        # Opens and validates the schedule file against the experiment's parameters
+        self.schedule, self.schedule_info = schedules.load_schedule(self.schedule_path, self)
+
+    def _prepare(self):
+        if self.schedule_path is not None:
+            self._load_schedule()
+            session = None
+        else:
+            session = self.make_session()
 
-        psychopy.core.wait(wait_time)
+        if self.wheel_texture is None:
+            self.wheel_texture = self._make_wheel_texture()
 
-    def display_stimuli(self, coordinates, colors):
+        return session
+
+    def prepare(self):
         """
-        Displays the stimuli.
+        Starts making the session and the color wheel texture on a background thread.
+
+        run calls this before the dialog is shown, so the work is done while the participant info is
+        being typed in, and collects the session once the dialog is closed. Because of this,
+        make_session, and make_block and make_trial if they are overwritten, must not depend on the
+        dialog answers or the window unless run is overwritten.
+        If self.schedule_path is set, the schedule file is opened instead of making a session.
+        """
+        if self._worker is None:
+            self._worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self._preparation = self._worker.submit(self._prepare)
+
+    def scheduled_session(self, subject, session):
+        """
+        Returns the blocks of a subject and session from the schedule file.
+
+        The blocks are memory mapped arrays of trial records, so nothing is read until they are run.
+        Sets self.number_of_blocks to the number of blocks in the file.
 
         Parameters:
-            coordinates -- A list of (x, y) tuples in visual degrees.
-            colors -- A list of -1 to 1 rgb color lists
+            subject -- The subject number, from 1.
+            session -- The session number, from 1.
         """
+        n_subjects, n_sessions = self.schedule.shape[:2]
 
-        for pos, color in zip(coordinates, colors):
-            psychopy.visual.Circle(
-                self.experiment_window, radius=self.stim_size, pos=pos, fillColor=color,
-                units='deg', lineColor=None).draw()
+        if not (1 <= subject <= n_subjects and 1 <= session <= n_sessions):
+            raise ValueError('The schedule {} has {} subjects with {} sessions, there is no subject {} session {}.'
+                             .format(self.schedule_path, n_subjects, n_sessions, subject, session))
+
+        self.number_of_blocks = self.schedule.shape[2]
+        return list(self.schedule[subject - 1, session - 1])
 
-        self.experiment_window.flip()
+    def _collect_session(self):
+        # Waits for prepare, then picks the subject's session if a schedule file is used. Subject and
+        # session numbers that are not in the schedule are shown in an error dialog and asked for again.
+        session = self._preparation.result()
 
-        psychopy.core.wait(self.sample_time)
+        while self.schedule is not None:
+            subject, session_number = self.experiment_info['Subject Number'], self.experiment_info['Session']
+            try:
+                return self.scheduled_session(int(subject), int(session_number))
+            except ValueError as e:
+                error_dlg = psychopy.gui.Dlg(title='Error')
+                error_dlg.addText(str(e) if str(subject).isdigit() and str(session_number).isdigit() else
+                                  'The subject and session numbers must be whole numbers.')
+                error_dlg.show()
 
-    def draw_color_wheels(self, coordinates, wheel_rotations):
+            if not self.get_experiment_info_from_dialog(self.questionaire_dict):
+                print('Experiment has been terminated.')
+                sys.exit(1)
+
+        return session
+
+    def prefetch_color_wheels(self, coordinates, wheel_rotations):
         """
-        Draws color wheels at stimuli locations with random rotation.
+        Prepares the color wheels while another display is shown.
+
+        The wheels are created as idle tasks, one per frame slice, and are used by the response
+        phase if it is started with the same coordinates and wheel_rotations lists.
 
         Parameters:
             coordinates -- A list of (x, y) tuples
-            wheel_rotations -- A list of 0:359 ints describing how much each wheel
+            wheel_rotations -- A list of ints (0 to wheel_size - 1) describing how much each wheel
                 should be rotated.
         """
-        mask = np.zeros([100, 1])
-        mask[-30:] = 1
+        self.add_idle_task(self._prefetch_color_wheels(coordinates, wheel_rotations))
 
-        for pos, rot in zip(coordinates, wheel_rotations):
-            rotated_wheel = np.roll(self.color_wheel, rot, axis=0)
-            tex = np.repeat(rotated_wheel[np.newaxis, :, :], 360, 0)
+    def cache_color_wheels(self):
+        """
+        Renders the remaining color wheels into self.response_display.
 
-            psychopy.visual.RadialStim(
-                self.experiment_window, tex=tex, mask=mask, pos=pos, angularRes=256,
-                angularCycles=1, interpolate=False, size=self.stim_size * 2).draw()
+        Only used if self.cache_response_display is True. The image has to be made again whenever
+        a wheel is removed from self.wheel_stims.
+        """
+        if self.cache_response_display and self.wheel_stims:
+            self.response_display = psychopy.visual.BufferImageStim(
+                self.experiment_window, stim=list(self.wheel_stims.values()))
+        else:
+            self.response_display = None
+
+    def draw_color_wheels(self, coordinates=None, wheel_rotations=None):
+        """
+        Draws the cached color wheels.
+
+        If coordinates and wheel_rotations are given, the cache is rebuilt first. If the wheels have
+        been rendered by cache_color_wheels, the rendered image is drawn instead.
+
+        Parameters:
+            coordinates -- A list of (x, y) tuples
+            wheel_rotations -- A list of ints (0 to wheel_size - 1) describing how much each wheel
+                should be rotated.
+        """
+        if coordinates is not None:
+            self.build_color_wheels(coordinates, wheel_rotations)
+
+        if self.response_display is not None:
+            self.response_display.draw()
+            return
 
-    def _calc_mouse_color(self, mouse_pos):
+        for stim in self.wheel_stims.values():
+            stim.draw()
+
+    def _read_pixel(self, x, y, radius=1):
         """
-        Calculates the color of the pixel the mouse is hovering over.
+        Reads back a small region of the screen and returns the rgb value of its center pixel.
+
+        Parameters:
+            x -- The pixel column, counted from the left edge of the window.
+            y -- The pixel row, counted from the top edge of the window.
+            radius -- How many pixels around the center to read.
+        """
+        width, height = self.experiment_window.size
+
+        if not (radius <= x < width - radius and radius <= y < height - radius):
+            return None
+
+        # _getFrame takes a [left, top, right, bottom] rect in norm units
+        rect = [(x - radius) / width * 2 - 1, 1 - (y - radius) / height * 2,
+                (x + radius + 1) / width * 2 - 1, 1 - (y + radius + 1) / height * 2]
+        region = np.array(self.experiment_window._getFrame(rect=rect))  # Uses psychopy internal function
+
+        try:
+            return region[radius, radius, :3]
+        except IndexError:
+            return None
+
+    def _calc_mouse_color(self, mouse_pos, wheel):
+        """
+        Calculates the rgb color (0 to 255) the mouse is hovering over and its color wheel index.
+
+        Returns an (rgb, index) tuple. If self.color_lookup is 'analytic', the index is calculated by
+        self.response_geometry from the angle of the mouse around the wheel. Otherwise the pixel under
+        the mouse is read back from the screen and the index is None, because neighboring wheel entries
+        can have the same rgb color. The rgb color is None if the mouse is outside the window.
 
         Parameters:
             mouse_pos -- A position returned by mouse.getPos()
+            wheel -- The index of the wheel under the mouse, from self.response_geometry.wheel_at.
         """
-        frame = np.array(self.experiment_window._getFrame())  # Uses psychopy internal function
+        if self.color_lookup == 'analytic':
+            index = self.response_geometry.color_index(wheel, mouse_pos)
+            return self.color_wheel_rgb[index], index
 
         x_correction = self.experiment_window.size[0] / 2
         y_correction = self.experiment_window.size[1] / 2
@@ -446,142 +960,269 @@ class ResolutionWR(template.BaseExperiment):
         y = (self.experiment_window.size[1] -
              int(psychopy.tools.monitorunittools.deg2pix(mouse_pos[1], self.experiment_monitor) + y_correction))
 
-        try:
-            color = frame[y, x, :]
-        except IndexError:
-            color = None
-
-        return color
+        return self._read_pixel(x, y), None
 
-    def _calc_mouse_position(self, coordinates, mouse_pos):
+    def _mouse_samples(self, start_time):
         """
-        Determines which position is closest to the mouse in order to display the hover preview.
+        Returns a list of (mouse_pos, left_click, rt) tuples since the last call.
+
+        When polling, there is always one sample with the current mouse state. With mouse events, this
+        waits up to one frame for events and returns one sample per event, which may be none.
 
         Parameters:
-            coordinates -- A list of (x, y) tuples
-            mouse_pos -- A position returned by mouse.getPos()
+            start_time -- The time rts are measured from when using mouse events.
         """
-        dists = [np.linalg.norm(np.array(i) - np.array(mouse_pos) / 2) for i in coordinates]
-        closest_dist = min(dists)
+        if self.mouse_events is None:
+            (lclick, _, _), (rt, _, _) = self.mouse.getPressed(getTime=True)
+            return [(self.mouse.getPos(), lclick, rt)]
 
-        if closest_dist < 4:
-            return coordinates[np.argmin(dists)]
-        else:
-            return None
+        self.mouse_events.wait(self.frame_period or 1 / 60)
 
-    def _response_loop(self, coordinates, wheel_rotations):
+        samples = []
+        for mouse_event in self.mouse_events.get():
+            mouse_pos = psychopy.tools.monitorunittools.pix2deg(
+                np.array(mouse_event.pos), self.experiment_monitor)
+            lclick = mouse_event.kind == 'press' and mouse_event.button == mouseevents.LEFT_BUTTON
+            samples.append((mouse_pos, lclick, mouse_event.time - start_time))
+
+        return samples
+
+    def _start_response_display(self, coordinates, wheel_rotations):
         """
-        Handles the hover updating and response clicks
+        Shows the color wheels and returns the time of the flip that showed them.
 
-        Slightly slow due to how psychopy handles clicks, so a full click and hold is needed.
+        The wheels are built first if they were not prefetched. Rts are measured from the returned time,
+        so the preparation is not included in them.
 
         Parameters:
             coordinates -- A list of (x, y) tuples
-            wheel_rotations -- A list of 0:359 ints describing how much each wheel
+            wheel_rotations -- A list of ints (0 to wheel_size - 1) describing how much each wheel
                 should be rotated.
         """
-        temp_coordinates = copy.copy(coordinates)
-        temp_rotations = copy.copy(wheel_rotations)
+        self._run_idle_tasks(math.inf)  # Finish prefetching that did not fit in the delay
+
+        if self._wheel_stims_for != (coordinates, wheel_rotations):
+            self.build_color_wheels(coordinates, wheel_rotations)
+
+        self._wheel_stims_for = None
+
+        self.cache_color_wheels()
 
-        resp_colors = [0] * len(coordinates)
-        rts = [0] * len(coordinates)
-        click_order = [0] * len(coordinates)
+        if self.preview_stim is None:
+            self.preview_stim = psychopy.visual.Circle(
+                self.experiment_window, radius=self.stim_size / 2, units='deg', lineColor=None)
 
-        click = 1
+        self._draw_response_display(None)
+        onset = self._flip()
+        self._response_onset = onset
 
         self.mouse.clickReset()
+        if self.mouse_events is not None:
+            self.mouse_events.clear()
 
-        self.draw_color_wheels(temp_coordinates, temp_rotations)
-        self.experiment_window.flip()
+        return onset
 
-        while True:
-            if psychopy.event.getKeys(keyList=['q']):
-                self.quit_experiment()
+    def _draw_response_display(self, preview):
+        """
+        Draws the remaining color wheels and then the preview of the hovered color.
 
-            (lclick, _, _), (rt, _, _) = self.mouse.getPressed(getTime=True)
+        The preview has to be drawn last, because the cached image of the wheels covers the whole window.
 
-            mouse_pos = self.mouse.getPos()
-            px_color = self._calc_mouse_color(mouse_pos)
+        Parameters:
+            preview -- The (position, rgb color) returned by _handle_mouse_sample, or None.
+        """
+        self.draw_color_wheels()
 
-            if px_color is not None and not np.array_equal(px_color, np.array([128, 128, 128])):
-                preview_pos = self._calc_mouse_position(temp_coordinates, mouse_pos)
+        if preview is not None:
+            self.preview_stim.pos = preview[0]
+            self.preview_stim.fillColor = template.convert_color_value(preview[1])
+            self.preview_stim.draw()
 
-                if preview_pos:
-                    if lclick:
-                        resp_colors[coordinates.index(preview_pos)] = px_color
-                        rts[coordinates.index(preview_pos)] = rt
-                        click_order[coordinates.index(preview_pos)] = click
-                        click += 1
+    def _handle_mouse_sample(self, mouse_pos, lclick, rt, coordinates, responses):
+        """
+        Handles one mouse sample of the response phase.
 
-                        del temp_rotations[temp_coordinates.index(preview_pos)]
-                        temp_coordinates.remove(preview_pos)
+        A click on a wheel is recorded in responses and removes the wheel. Returns the (position, rgb
+        color) of the preview to show for a hover, or None.
 
-                        if not temp_coordinates:
-                            return resp_colors, rts, click_order
-                    else:
-                        psychopy.visual.Circle(
-                            self.experiment_window, radius=self.stim_size / 2, pos=preview_pos,
-                            fillColor=template.convert_color_value(px_color), units='deg',
-                            lineColor=None).draw()
+        Parameters:
+            mouse_pos -- The position of the mouse.
+            lclick -- True if the left button was pressed.
+            rt -- The time of the sample from the start of the response phase.
+            coordinates -- A list of (x, y) tuples
+            responses -- The lists returned by get_response, which are filled in.
+        """
+        geometry = self.response_geometry
+        location = geometry.wheel_at(mouse_pos)
 
-            self.draw_color_wheels(temp_coordinates, temp_rotations)
-            self.experiment_window.flip()
+        if location is None:
+            return None
 
-    def get_response(self, coordinates, wheel_rotations):
+        px_color, color_index = self._calc_mouse_color(mouse_pos, location)
+
+        if px_color is None or np.array_equal(px_color, np.array([128, 128, 128])):
+            return None
+
+        if not lclick:
+            return coordinates[location], px_color
+
+        resp_colors, rts, click_order, resp_indexes = responses
+        resp_colors[location] = px_color
+        rts[location] = rt
+        click_order[location] = len(coordinates) - geometry.remaining + 1
+        resp_indexes[location] = color_index
+
+        del self.wheel_stims[location]
+        geometry.remove(location)
+
+        if geometry.remaining:
+            self.cache_color_wheels()
+
+        return None
+
+    def _response_loop(self, coordinates, wheel_rotations):
         """
-        Manages getting responses for all color wheels.
+        Handles the hover updating and response clicks
+
+        When polling, psychopy only reports the button state each frame, so a full click and hold is
+        needed. With mouse events every press is used and the screen is only redrawn when the mouse moves,
+        so the intervals between those flips are not counted as long frames.
 
         Parameters:
             coordinates -- A list of (x, y) tuples
-            wheel_rotations -- A list of 0:359 ints describing how much each wheel
+            wheel_rotations -- A list of ints (0 to wheel_size - 1) describing how much each wheel
                 should be rotated.
         """
-        if not self.mouse:
-            self.mouse = psychopy.event.Mouse(visible=False, win=self.experiment_window)
+        n = len(coordinates)
+        responses = ([0] * n, [0] * n, [0] * n, [None] * n)
 
-        self.mouse.setVisible(1)
-        psychopy.event.clearEvents()
+        with self._phase('response_setup'):
+            start_time = self._start_response_display(coordinates, wheel_rotations)
 
-        resp_colors, rts, click_order = self._response_loop(coordinates, wheel_rotations)
+        with self._phase('response_loop'):
+            while True:
+                if psychopy.event.getKeys(keyList=['q']):
+                    self.quit_experiment()
 
-        self.mouse.setVisible(0)
+                samples = self._mouse_samples(start_time)
+
+                if not samples:
+                    continue
+
+                for mouse_pos, lclick, rt in samples:
+                    preview = self._handle_mouse_sample(mouse_pos, lclick, rt, coordinates, responses)
+
+                    if not self.response_geometry.remaining:
+                        self.response_display = None
+                        return responses
+
+                self._draw_response_display(preview)
 
-        return resp_colors, rts, click_order
+                if self.mouse_events is not None:
+                    self._frame_gap()
+                self._flip()
 
-    def calculate_error(self, color_index, resp_color):
+    def get_response(self, coordinates, wheel_rotations):
         """
-        Calculates error in a response compared to the true color value.
+        Manages getting responses for all color wheels.
+
+        Returns lists with the rgb color, rt, click number and color wheel index of the response to each
+        wheel. The indexes are None if they were not calculated (see _calc_mouse_color).
 
         Parameters:
-            color_index -- The index of the true color values (0:359).
-            resp_color -- The rgb color that was selected.
+            coordinates -- A list of (x, y) tuples
+            wheel_rotations -- A list of ints (0 to wheel_size - 1) describing how much each wheel
+                should be rotated.
         """
-        row_index = np.where((self.color_wheel == resp_color).all(axis=1))[0]
+        with self._phase('response_setup'):
+            if not self.mouse:
+                self.mouse = psychopy.event.Mouse(visible=False, win=self.experiment_window)
 
-        if row_index.shape[0] < 1:
-            return None  # if empty, return None
+            if self.response_mode == 'events' and self.mouse_events is None:
+                if mouseevents.MouseEventQueue.supported(self.experiment_window):
+                    self.mouse_events = mouseevents.MouseEventQueue(
+                        self.experiment_window, clock=psychopy.core.getTime)
+                else:
+                    print('Mouse events need the pyglet backend, polling the mouse instead.')
+                    self.response_mode = 'polling'
 
-        raw_error = row_index[0] - color_index
-        if raw_error >= -180 and raw_error <= 180:
-            error = raw_error
-        elif raw_error < -180:
-            error = 360 + raw_error
-        else:
-            error = raw_error - 360
+            self.mouse.setVisible(1)
+            psychopy.event.clearEvents()
 
-        return error
+        responses = self._response_loop(coordinates, wheel_rotations)
+
+        self.mouse.setVisible(0)
+
+        return responses
 
     def send_data(self, data):
         """Updates the experiment data with the information from the last trial.
 
         This function is seperated from run_trial to allow additional information to be added
-        afterwards.
+        afterwards. The data is always added to self.experiment_data, and if data is being streamed, it
+        is also queued to be written immediately. The live stats and status file are updated if
+        break_stats or status_path are set.
 
         Parameters:
             data -- A dict where keys exist in data_fields and values are to be saved.
         """
         self.update_experiment_data(data)
 
+        if self.data_writer is not None:
+            self.data_writer.write(data)
+
+        if self.columnar_writer is not None:
+            self.columnar_writer.write(data)
+
+        if self.network_sink is not None:
+            self.network_sink.write(data)
+
+        if self.live_stats is not None and data:
+            self.live_stats.update(data)
+            if self.status_path is not None:
+                self.live_stats.save(self.status_path, subject=data[-1].get('Subject'),
+                                     session=data[-1].get('Session'), block=data[-1].get('Block'),
+                                     trial=data[-1].get('Trial'))
+
+    def save_data_to_csv(self):
+        """Makes sure all sent data is in the csv file.
+
+        If data is being streamed, this waits for the background writer to catch up and clears
+        self.experiment_data like the base method does. Otherwise the base method writes the data
+        collected since the last save. The columnar file is also updated and rows waiting to be sent to
+        the data server are saved in the spool.
+        """
+        if self.data_writer is not None:
+            self.data_writer.flush()
+            self.experiment_data = []
+        else:
+            super().save_data_to_csv()
+
+        if self.columnar_writer is not None:
+            self.columnar_writer.save()
+
+        if self.network_sink is not None:
+            self.network_sink.spool()
+
+        self._save_frame_timing()
+        self._save_profile()
+
+    def quit_experiment(self):
+        """Closes the data files and quits the experiment."""
+        if self.data_writer is not None:
+            self.data_writer.close()
+
+        if self.network_sink is not None:
+            self.network_sink.close()
+
+        if self.columnar_writer is not None:
+            self.columnar_writer.save()
+
+        self._save_frame_timing()
+        self._save_profile()
+
+        super().quit_experiment()
+
     def run_trial(self, trial, block_num, trial_num):
         """
         Runs a single trial.
@@ -591,15 +1232,62 @@ class ResolutionWR(template.BaseExperiment):
             block_num -- The block number to be saved in the output csv.
             trial_num -- The trial number to be saved in the output csv.
         """
-        self.display_blank(self.iti_time)
-        self.display_stimuli(trial['locations'], trial['color_values'])
-        self.display_blank(self.delay_time)
-        resp_colors, rts, click_order = self.get_response(trial['locations'], trial['wheel_rotations'])
+        if self.profiler is not None:
+            self.profiler.start_trial(block_num, trial_num)
+
+        self._frame_gap()  # The data of the last trial was saved since its last flip
+
+        # The index of the first flip of each phase, used if frame times are being recorded
+        flips = [self._flip_count()]
+        with self._phase('iti'):
+            self.prefetch_stimuli(trial['locations'], trial['color_values'])
+            self.display_blank(self.iti_time)
+        flips.append(self._flip_count())
+        with self._phase('sample'):
+            stimulus_onset = self.display_stimuli(trial['locations'], trial['color_values'])
+        flips.append(self._flip_count())
+        with self._phase('delay'):
+            self.prefetch_color_wheels(trial['locations'], trial['wheel_rotations'])
+            delay_onset = self.display_blank(self.delay_time)
+        flips.append(self._flip_count())
+        responses = self.get_response(trial['locations'], trial['wheel_rotations'])
+
+        # Each display lasted until the flip that showed the next one
+        durations = (delay_onset - stimulus_onset, self._response_onset - delay_onset)
+
+        with self._phase('data'):
+            data = self._trial_data(trial, block_num, trial_num, responses, durations, flips)
+
+        if self.profiler is not None:
+            self.profiler.end_trial()
+
+        return data
 
+    def _trial_data(self, trial, block_num, trial_num, responses, durations, flips):
+        """
+        Returns the data rows of a trial.
+
+        Parameters:
+            trial -- The trial dictionary.
+            block_num -- The block number to be saved in the output csv.
+            trial_num -- The trial number to be saved in the output csv.
+            responses -- The lists returned by get_response.
+            durations -- The measured (stimulus, retention) durations, from the onset flip of each display
+                to the onset flip of the next one.
+            flips -- The indexes of the first flip of each phase, see _frame_timing_data.
+        """
         data = []
         timestamp = psychopy.core.getAbsTime()
 
-        for i, (color, rt, click) in enumerate(zip(resp_colors, rts, click_order)):
+        for i, (color, rt, click, index) in enumerate(zip(*responses)):
+            # Plain floats instead of numpy scalars, which are smaller and print the same with any numpy
+            resp_color = template.convert_color_value(np.asarray(color).tolist())
+            if index is not None:
+                resp_rgb = self.color_wheel_rgb[index].tolist()
+            elif color is not None:
+                resp_rgb = np.asarray(color).tolist()
+            else:
+                resp_rgb = None
             data.append({
                 'Subject': self.experiment_info['Subject Number'],
                 'Session': self.experiment_info['Session'],
@@ -613,17 +1301,34 @@ class ResolutionWR(template.BaseExperiment):
                 'LocationY': trial['locations'][i][1],
                 'ColorIndex': trial['color_indexes'][i],
                 'TrueColor': trial['color_values'][i],
-                'RespColor': template.convert_color_value(color),
-                'Error': self.calculate_error(trial['color_indexes'][i], template.convert_color_value(color)),
+                'RespColor': resp_color,
+                # The exact 0 to 255 colors, which are not in data_fields but are saved by the columnar writer
+                'TrueColorRGB': self.color_wheel_rgb[trial['color_indexes'][i]].tolist(),
+                'RespColorRGB': resp_rgb,
+                'Error': self.calculate_error(trial['color_indexes'][i], resp_color if index is None else index),
                 'RT': rt,
+                'StimulusDuration': durations[0],
+                'RetentionDuration': durations[1],
             })
 
+        if self.frame_timer is not None:
+            frame_timing = self._frame_timing_data(*flips)
+            for row in data:
+                row.update(frame_timing)
+
         return data
 
     def display_break(self):
-        """Displays a break screen in between blocks."""
+        """Displays a break screen in between blocks.
+
+        If self.break_stats is True, the live stats of each set size are shown below the message.
+        """
 
         break_text = 'Please take a short break. Press space to continue.'
+
+        if self.break_stats:
+            break_text += '\n\n' + '\n'.join(self.live_stats.format())
+
         self.display_text_screen(text=break_text, bg_color=[204, 255, 204])
 
     def run(self, setup_hook=None, before_first_trial_hook=None, pre_block_hook=None,
@@ -642,7 +1347,7 @@ class ResolutionWR(template.BaseExperiment):
             before_first_trial_hook -- takes self, executed after instructions are displayed.
             pre_block_hook -- takes self, block list, and block num
                 Executed immediately before block start.
-                Can optionally return an altered block list.
+                Can optionally return an altered block list, or any iterable of trials.
             pre_trial_hook -- takes self, trial dict, block num, and trial num
                 Executed immediately before trial start.
                 Can optionally return an altered trial dict.
@@ -653,6 +1358,7 @@ class ResolutionWR(template.BaseExperiment):
             end_experiment_hook -- takes self, executed immediately before end experiment screen.
         """
         self.chdir()
+        self.prepare()
 
         ok = self.get_experiment_info_from_dialog(self.questionaire_dict)
 
@@ -660,6 +1366,7 @@ class ResolutionWR(template.BaseExperiment):
             print('Experiment has been terminated.')
             sys.exit(1)
 
+        self.session = self._collect_session()
         self.save_experiment_info()
         self.open_csv_data_file()
         self.open_window(screen=0)
@@ -675,14 +1382,18 @@ class ResolutionWR(template.BaseExperiment):
             before_first_trial_hook(self)
 
         for block_num in range(self.number_of_blocks):
-            block = self.make_block()
+            block = self.session[block_num]
 
             if pre_block_hook is not None:
+                block = self.expand_block(block)
                 tmp = pre_block_hook(self, block, block_num)
                 if tmp is not None:
                     block = tmp
 
             for trial_num, trial in enumerate(block):
+                # The session is kept as compact trial records until each trial is run
+                trial = self.expand_trial(trial)
+
                 if pre_trial_hook is not None:
                     tmp = pre_trial_hook(self, trial, block_num, trial_num)
                     if tmp is not None:
@@ -695,15 +1406,20 @@ class ResolutionWR(template.BaseExperiment):
                     if tmp is not None:
                         data = tmp
 
-                self.send_data(data)
+                with self._phase('send_data'):
+                    self.send_data(data)
 
-            self.save_data_to_csv()
+            with self._phase('save_data'):
+                self.save_data_to_csv()
 
             if post_block_hook is not None:
                 post_block_hook(self)
 
-            if block_num + 1 != self.number_of_blocks:
-                self.display_break()
+            # A hook can end the session early by lowering number_of_blocks (see adaptive.py)
+            if block_num + 1 >= self.number_of_blocks:
+                break
+
+            self.display_break()
 
         if end_experiment_hook is not None:
             end_experiment_hook(self)
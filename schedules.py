@@ -0,0 +1,230 @@
+"""Precomputed session schedules for ResolutionWR.
+
+Generates the trials of every session of every subject ahead of time and saves them as one numpy
+array of trial records (see wrcore.trial_dtype), so schedules can be checked before the experiment
+and ResolutionWR only has to memory map the file (see its schedule_path parameter). A json file with
+the design is saved next to the schedule.
+
+Usage:
+    python schedules.py --subjects 40 --sessions 2 --seed 1 --output schedule.npy
+
+The set sizes of each block are run in rounds that contain every set size once, and the order of
+each round is a row of a balanced Latin square, so every set size appears equally often at every
+position and after every other set size. With --shared-items every subject sees the same colors,
+rotations and locations for each set size of a session, in the same order.
+
+Functions:
+balanced_orders -- Returns the rows of a balanced Latin square.
+load_schedule -- Loads a schedule file and its design.
+make_schedule -- Generates the trial records of every session of every subject.
+save_schedule -- Saves a schedule and its design.
+schedule_info_filename -- Returns the name of the json file saved next to a schedule.
+"""
+
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+import wrcore
+
+
+SCHEDULE_VERSION = 1
+
+
+def balanced_orders(n):
+    """
+    Returns the rows of a balanced Latin square.
+
+    Each row is an order of range(n). Every number appears once at every position and, over all
+    rows, follows every other number equally often. There are n rows if n is even and 2n if odd.
+
+    Parameters:
+        n -- The number of items to order.
+    """
+    first = [0] + [(j + 1) // 2 if j % 2 else n - j // 2 for j in range(1, n)]
+    rows = [[(item + shift) % n for item in first] for shift in range(n)]
+
+    if n % 2:
+        rows += [row[::-1] for row in rows]
+
+    return np.array(rows)
+
+
+def _session_items(generator, rng):
+    """Generates the trial records of each set size for one session, shaped (blocks, trials_per_set_size)."""
+    generator.rng = rng
+    shape = (generator.number_of_blocks, generator.trials_per_set_size)
+
+    return [generator.trial_records(set_size, shape[0] * shape[1]).reshape(shape)
+            for set_size in generator.set_sizes]
+
+
+def make_schedule(generator, n_subjects, n_sessions, counterbalance=True, shared_items=False, seed=None):
+    """
+    Generates the trial records of every session of every subject.
+
+    Returns an array with generator.trial_dtype and shape (subjects, sessions, blocks, trials per block).
+    Subjects and sessions are numbered from 1, so the session of subject s is schedule[s - 1, session - 1].
+
+    Parameters:
+        generator -- A wrcore.TrialGenerator with the design. Its rng is replaced while generating.
+        n_subjects -- The number of subjects.
+        n_sessions -- The number of sessions per subject.
+        counterbalance -- If True, set sizes are ordered in rounds from a balanced Latin square that
+            is rotated over subjects, sessions and blocks. If False, every block is shuffled.
+        shared_items -- If True, every subject gets the same items for each set size of a session.
+        seed -- Seed for the random values. None gives a different schedule every time.
+    """
+    n_set_sizes = len(generator.set_sizes)
+    per_set_size = generator.trials_per_set_size
+    n_blocks = generator.number_of_blocks
+
+    schedule = np.zeros((n_subjects, n_sessions, n_blocks, per_set_size * n_set_sizes), dtype=generator.trial_dtype)
+    orders = balanced_orders(n_set_sizes)
+
+    seeds = np.random.SeedSequence(seed).spawn(n_sessions if shared_items else n_subjects * n_sessions)
+    shared = [_session_items(generator, np.random.default_rng(s)) for s in seeds] if shared_items else None
+
+    for subject in range(n_subjects):
+        for session in range(n_sessions):
+            if shared_items:
+                items = shared[session]
+            else:
+                rng = np.random.default_rng(seeds[subject * n_sessions + session])
+                items = _session_items(generator, rng)
+
+            for block in range(n_blocks):
+                if counterbalance:
+                    first_round = subject + (session * n_blocks + block) * per_set_size
+                    rounds = (first_round + np.arange(per_set_size)) % len(orders)
+                    order = orders[rounds].ravel()
+                else:
+                    order = generator.rng.permutation(np.repeat(np.arange(n_set_sizes), per_set_size))
+
+                for i in range(n_set_sizes):
+                    schedule[subject, session, block, order == i] = items[i][block]
+
+    return schedule
+
+
+def schedule_info_filename(filename):
+    """Returns the name of the json file saved next to a schedule."""
+    return os.path.splitext(filename)[0] + '.json'
+
+
+def _color_wheel_hash(generator):
+    return hashlib.sha1(np.ascontiguousarray(generator.color_wheel_rgb, dtype=np.int64).tobytes()).hexdigest()
+
+
+def save_schedule(filename, schedule, generator, **design):
+    """
+    Saves a schedule and its design.
+
+    The schedule is saved as a .npy file and the design as json next to it (see
+    schedule_info_filename). Both files are replaced atomically.
+
+    Parameters:
+        filename -- The path of the .npy file.
+        schedule -- An array returned by make_schedule.
+        generator -- The wrcore.TrialGenerator used to make it.
+        design -- Other json serializable values to save with the design (e.g. seed).
+    """
+    info = {
+        'version': SCHEDULE_VERSION,
+        'subjects': schedule.shape[0],
+        'sessions': schedule.shape[1],
+        'number_of_blocks': schedule.shape[2],
+        'trials_per_block': schedule.shape[3],
+        'set_sizes': list(generator.set_sizes),
+        'trials_per_set_size': generator.trials_per_set_size,
+        'wheel_size': generator.wheel_size,
+        'color_wheel_hash': _color_wheel_hash(generator),
+    }
+    info.update(design)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, schedule)
+    os.replace(tmp_filename, filename)
+
+    info_filename = schedule_info_filename(filename)
+    with open(info_filename + '.tmp', 'w') as f:
+        json.dump(info, f, indent=2)
+    os.replace(info_filename + '.tmp', info_filename)
+
+
+def load_schedule(filename, generator=None):
+    """
+    Loads a schedule file and its design.
+
+    Returns a (schedule, info) tuple. The schedule is memory mapped, so only the blocks that are used
+    are read from disk.
+
+    Parameters:
+        filename -- The path of a .npy file written by save_schedule.
+        generator -- If given, a ValueError is raised if the schedule was made with a different color
+            wheel, set sizes or number of trials per set size. The number of blocks can differ, because
+            ResolutionWR takes it from the schedule.
+    """
+    with open(schedule_info_filename(filename)) as f:
+        info = json.load(f)
+
+    if info.get('version') != SCHEDULE_VERSION:
+        raise ValueError('Unsupported schedule version in ' + schedule_info_filename(filename))
+
+    schedule = np.load(filename, mmap_mode='r')
+
+    if generator is not None:
+        if info['wheel_size'] != generator.wheel_size or info['color_wheel_hash'] != _color_wheel_hash(generator):
+            raise ValueError('The schedule ' + filename + ' was made with a different color wheel.')
+        if sorted(info['set_sizes']) != sorted(generator.set_sizes):
+            raise ValueError('The schedule {} has set sizes {}, but the experiment has {}.'
+                             .format(filename, info['set_sizes'], list(generator.set_sizes)))
+        if info['trials_per_set_size'] != generator.trials_per_set_size:
+            raise ValueError('The schedule {} has {} trials per set size, but the experiment has {}.'
+                             .format(filename, info['trials_per_set_size'], generator.trials_per_set_size))
+
+    return schedule, info
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--subjects', type=int, required=True)
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--set-sizes', type=int, nargs='+', default=[1, 2, 4, 6])
+    parser.add_argument('--trials-per-set-size', type=int, default=5, help='Per block (default 5).')
+    parser.add_argument('--blocks', type=int, default=2)
+    parser.add_argument('--distance-from-fixation', type=float, default=6)
+    parser.add_argument('--min-color-dist', type=float, default=25)
+    parser.add_argument('--colorwheel-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  'colors.json'))
+    parser.add_argument('--wheel-size', type=int)
+    parser.add_argument('--shuffle', action='store_true', help='Shuffle blocks instead of counterbalancing.')
+    parser.add_argument('--shared-items', action='store_true',
+                        help='Give every subject the same items in each session.')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', default='schedule.npy')
+    args = parser.parse_args(argv)
+
+    generator = wrcore.TrialGenerator(
+        set_sizes=args.set_sizes, trials_per_set_size=args.trials_per_set_size, number_of_blocks=args.blocks,
+        distance_from_fixation=args.distance_from_fixation, min_color_dist=args.min_color_dist,
+        colorwheel_path=args.colorwheel_path, wheel_size=args.wheel_size)
+
+    schedule = make_schedule(generator, args.subjects, args.sessions, not args.shuffle, args.shared_items, args.seed)
+    save_schedule(args.output, schedule, generator, counterbalance=not args.shuffle,
+                  shared_items=args.shared_items, seed=args.seed)
+
+    print('Saved {} sessions of {} trials to {} ({:.1f} MB)'.format(
+        args.subjects * args.sessions, schedule.shape[2] * schedule.shape[3], args.output, schedule.nbytes / 1e6))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""Simulates model observers in ResolutionWR without a display.
+
+Trials are generated by wrcore.TrialGenerator, the same code ResolutionWR uses, and responses come
+from a model observer instead of the mouse. Everything is done with numpy arrays, so millions of
+trials can be simulated quickly, and grids of observers are simulated on a process pool.
+
+Usage:
+    python simulate.py --capacity 2 3 4 --kappa 5 10 --sessions 20 --output simulations
+
+Classes:
+Observer -- A model observer with a capacity, precision, swap rate and guess rate.
+
+Functions:
+save_csv -- Saves simulated columns to a csv file like the ones written by ResolutionWR.
+simulate_grid -- Simulates sessions for a list of observers on a process pool.
+simulate_session -- Simulates one session and returns the data as columns.
+to_rows -- Converts simulated columns into the row dicts returned by ResolutionWR.run_trial.
+"""
+
+
+import argparse
+import concurrent.futures
+import itertools
+import os
+import sys
+
+import numpy as np
+
+import datasinks
+import wrcore
+
+
+class Observer(object):
+    """
+    A model observer with a capacity, precision, swap rate and guess rate.
+
+    Each item is remembered with probability min(1, capacity / set_size). Remembered items are reported
+    with von Mises noise whose concentration is kappa * set_size ** -kappa_slope, and with probability
+    swap_rate the color of a random other item is reported instead. Items that are not remembered, and
+    guess_rate of the remembered ones, are reported as a random color.
+
+    Parameters:
+    capacity -- The number of items that can be remembered.
+    kappa -- The von Mises concentration (in radians) of remembered items at set size 1.
+    kappa_slope -- How fast the concentration falls with set size. 0 keeps it constant.
+    swap_rate -- The probability of reporting a non-target color when there is more than one item.
+    guess_rate -- The probability of guessing even though the item was remembered.
+
+    Methods:
+    respond -- Returns response color indexes for an array of trials.
+    """
+    def __init__(self, capacity=3, kappa=10, kappa_slope=0, swap_rate=0, guess_rate=0):
+        for name, rate in (('swap_rate', swap_rate), ('guess_rate', guess_rate)):
+            if not 0 <= rate <= 1:
+                raise ValueError(name + ' must be between 0 and 1.')
+
+        self.capacity = capacity
+        self.kappa = kappa
+        self.kappa_slope = kappa_slope
+        self.swap_rate = swap_rate
+        self.guess_rate = guess_rate
+
+    def __repr__(self):
+        return 'Observer(capacity={}, kappa={}, kappa_slope={}, swap_rate={}, guess_rate={})'.format(
+            self.capacity, self.kappa, self.kappa_slope, self.swap_rate, self.guess_rate)
+
+    def respond(self, color_indexes, wheel_size, rng):
+        """
+        Returns response color indexes for an array of trials.
+
+        Parameters:
+            color_indexes -- An (n_trials, set_size) array of true color indexes.
+            wheel_size -- The number of colors on the color wheel.
+            rng -- A numpy Generator.
+        """
+        n, set_size = color_indexes.shape
+
+        remembered = rng.random((n, set_size)) < min(1, self.capacity / set_size)
+        guess = ~remembered | (rng.random((n, set_size)) < self.guess_rate)
+
+        source = np.broadcast_to(np.arange(set_size), (n, set_size))
+        if set_size > 1:
+            swap = rng.random((n, set_size)) < self.swap_rate
+            source = np.where(swap, (source + rng.integers(1, set_size, size=(n, set_size))) % set_size, source)
+
+        reported = np.take_along_axis(color_indexes, source, axis=1)
+        kappa = self.kappa * set_size ** -self.kappa_slope
+        noise = rng.vonmises(0, kappa, size=(n, set_size)) * wheel_size / (2 * np.pi)
+
+        responses = np.where(guess, rng.integers(0, wheel_size, size=(n, set_size)),
+                             np.rint(reported + noise).astype(int))
+
+        return responses % wheel_size
+
+
+def simulate_session(observer, generator, number_of_blocks=None, subject=1, session=1):
+    """
+    Simulates one session and returns the data as columns.
+
+    The blocks are made by generator.make_session_records, so with the same seed they have the same
+    trials, in the same order, as the session ResolutionWR runs. The responses are drawn afterwards and
+    the click order of each trial is random. Returns a dict of arrays with the Subject, Session, Block,
+    Trial, LocationNumber, ClickNumber, SetSize, LocationX, LocationY, ColorIndex, RespIndex and Error of
+    every response, sorted by block, trial and location.
+
+    Parameters:
+        observer -- An Observer.
+        generator -- A wrcore.TrialGenerator (or ResolutionWR) that generates the trials.
+        number_of_blocks -- The number of blocks (defaults to generator.number_of_blocks).
+        subject -- The subject number saved in the data.
+        session -- The session number saved in the data.
+    """
+    blocks = generator.make_session_records(number_of_blocks)
+    records = np.concatenate(blocks)
+    rng = generator.rng
+
+    block_numbers = np.repeat(np.arange(len(blocks)), [len(block) for block in blocks])
+    trial_numbers = np.concatenate([np.arange(len(block)) for block in blocks])
+
+    parts = []
+    for set_size in generator.set_sizes:
+        trials = np.flatnonzero(records['set_size'] == set_size)
+        colors = records['color_indexes'][trials, :set_size].astype(int)
+        locations = records['locations'][trials, :set_size]
+        responses = observer.respond(colors, generator.wheel_size, rng)
+        n_trials = trials.shape[0]
+
+        parts.append({
+            'Block': np.repeat(block_numbers[trials], set_size),
+            'Trial': np.repeat(trial_numbers[trials], set_size),
+            'LocationNumber': np.tile(np.arange(1, set_size + 1), n_trials),
+            'ClickNumber': rng.random((n_trials, set_size)).argsort(axis=1).argsort(axis=1).ravel() + 1,
+            'SetSize': np.full(n_trials * set_size, set_size),
+            'LocationX': locations[..., 0].ravel(),
+            'LocationY': locations[..., 1].ravel(),
+            'ColorIndex': colors.ravel(),
+            'RespIndex': responses.ravel(),
+            'Error': generator.calculate_errors(colors, responses).ravel(),
+        })
+
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = np.lexsort((columns['LocationNumber'], columns['Trial'], columns['Block']))
+
+    data = {
+        'Subject': np.full(order.shape[0], subject),
+        'Session': np.full(order.shape[0], session),
+    }
+    data.update((name, column[order]) for name, column in columns.items())
+
+    return data
+
+
+def to_rows(columns, generator):
+    """
+    Converts simulated columns into the row dicts returned by ResolutionWR.run_trial.
+
+    Timestamp, RT and the display durations are None because nothing is displayed.
+
+    Parameters:
+        columns -- A dict returned by simulate_session.
+        generator -- The wrcore.TrialGenerator used for the simulation.
+    """
+    rows = []
+    lists = {name: column.tolist() for name, column in columns.items()}
+
+    for i in range(columns['Subject'].shape[0]):
+        rows.append({
+            'Subject': lists['Subject'][i],
+            'Session': lists['Session'][i],
+            'Block': lists['Block'][i],
+            'Trial': lists['Trial'][i],
+            'LocationNumber': lists['LocationNumber'][i],
+            'ClickNumber': lists['ClickNumber'][i],
+            'Timestamp': None,
+            'SetSize': lists['SetSize'][i],
+            'LocationX': lists['LocationX'][i],
+            'LocationY': lists['LocationY'][i],
+            'ColorIndex': lists['ColorIndex'][i],
+            'TrueColor': generator.color_wheel[lists['ColorIndex'][i]],
+            'RespColor': generator.color_wheel[lists['RespIndex'][i]].tolist(),
+            'Error': lists['Error'][i],
+            'RT': None,
+            'StimulusDuration': None,
+            'RetentionDuration': None,
+        })
+
+    return rows
+
+
+def save_csv(columns, generator, filename):
+    """
+    Saves simulated columns to a csv file like the ones written by ResolutionWR.
+
+    Parameters:
+        columns -- A dict returned by simulate_session.
+        generator -- The wrcore.TrialGenerator used for the simulation.
+        filename -- The path of the csv file. It is replaced if it exists.
+    """
+    rows = to_rows(columns, generator)
+
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+    writer = datasinks.StreamingCsvWriter(filename, list(rows[0]) if rows else [], fsync_interval=None)
+    writer.write(rows)
+    writer.close()
+
+
+def _simulate_sessions(observer, generator_kwargs, n_sessions, seed):
+    generator = wrcore.TrialGenerator(seed=seed, **generator_kwargs)
+    return [simulate_session(observer, generator, subject=i + 1) for i in range(n_sessions)]
+
+
+def simulate_grid(observers, generator_kwargs, n_sessions=1, seed=None, max_workers=None):
+    """
+    Simulates sessions for a list of observers on a process pool.
+
+    Every observer gets its own independent random stream derived from seed. Returns a list with a
+    list of n_sessions column dicts (see simulate_session) for each observer, numbered as subjects.
+
+    Parameters:
+        observers -- A list of Observers, e.g. every combination of a parameter grid.
+        generator_kwargs -- Sent to wrcore.TrialGenerator (set_sizes, trials_per_set_size,
+            number_of_blocks, distance_from_fixation, min_color_dist, colorwheel_path, ...).
+        n_sessions -- The number of sessions to simulate for each observer.
+        seed -- Seed for the random streams. None gives different results every time.
+        max_workers -- The number of processes. Defaults to the number of CPUs.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(observers))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(_simulate_sessions, observer, generator_kwargs, n_sessions, observer_seed)
+                   for observer, observer_seed in zip(observers, seeds)]
+        return [future.result() for future in futures]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--capacity', type=float, nargs='+', default=[3])
+    parser.add_argument('--kappa', type=float, nargs='+', default=[10])
+    parser.add_argument('--kappa-slope', type=float, nargs='+', default=[0])
+    parser.add_argument('--swap-rate', type=float, nargs='+', default=[0])
+    parser.add_argument('--guess-rate', type=float, nargs='+', default=[0])
+    parser.add_argument('--sessions', type=int, default=1, help='Sessions per observer (default 1).')
+    parser.add_argument('--set-sizes', type=int, nargs='+', default=[1, 2, 4, 6])
+    parser.add_argument('--trials-per-set-size', type=int, default=5)
+    parser.add_argument('--blocks', type=int, default=2)
+    parser.add_argument('--distance-from-fixation', type=float, default=6)
+    parser.add_argument('--min-color-dist', type=float, default=25)
+    parser.add_argument('--colorwheel-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  'colors.json'))
+    parser.add_argument('--wheel-size', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--workers', type=int, help='The number of processes (default the number of CPUs).')
+    parser.add_argument('--output', default='simulations', help='The directory for the csv files.')
+    args = parser.parse_args(argv)
+
+    grid = list(itertools.product(args.capacity, args.kappa, args.kappa_slope, args.swap_rate, args.guess_rate))
+    observers = [Observer(*params) for params in grid]
+    generator_kwargs = {
+        'set_sizes': args.set_sizes,
+        'trials_per_set_size': args.trials_per_set_size,
+        'number_of_blocks': args.blocks,
+        'distance_from_fixation': args.distance_from_fixation,
+        'min_color_dist': args.min_color_dist,
+        'colorwheel_path': args.colorwheel_path,
+        'wheel_size': args.wheel_size,
+    }
+
+    results = simulate_grid(observers, generator_kwargs, args.sessions, args.seed, args.workers)
+
+    os.makedirs(args.output, exist_ok=True)
+    generator = wrcore.TrialGenerator(**generator_kwargs)
+
+    for i, (observer, sessions) in enumerate(zip(observers, results)):
+        print('Simulation_{:03d}: {!r}'.format(i, observer))
+        for columns in sessions:
+            filename = 'Simulation_{:03d}_{:03d}_001.csv'.format(i, columns['Subject'][0])
+            save_csv(columns, generator, os.path.join(args.output, filename))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,391 @@
+"""Timing tools used by ResolutionWR to check the timing of the display.
+
+Classes:
+FrameTimer -- Records flip timestamps and finds frames that took too long.
+LatencyHistogram -- A fixed size histogram of durations with log spaced bins.
+PhaseProfiler -- Times the phases of each trial and runs chosen trials under cProfile.
+"""
+
+
+import cProfile
+import io
+import json
+import math
+import os
+import pstats
+import time
+
+import numpy as np
+
+
+class FrameTimer(object):
+    """
+    Records flip timestamps and finds frames that took too long.
+
+    Timestamps are stored in a preallocated buffer, so recording a flip does not allocate.
+    The buffer doubles in size if it fills up. Intervals that follow a gap marked with mark_gap, e.g.
+    a wait instead of flipping every frame, are left out of the intervals and long frames.
+
+    Parameters:
+    frame_period -- The expected number of seconds between flips.
+    threshold -- Frames longer than this many seconds are flagged. Defaults to 1.5 frame periods.
+    capacity -- The number of flips the buffer initially has space for.
+
+    Methods:
+    intervals -- Returns the intervals between flips.
+    long_frames -- Returns the indexes of the flips that came later than the threshold.
+    mark_gap -- Marks a pause in flipping, so the interval before the next flip is not scored.
+    record -- Records a flip timestamp.
+    save -- Writes a json summary including a histogram of the frame intervals.
+    summary -- Returns a dict summarizing the frame intervals.
+    """
+    def __init__(self, frame_period, threshold=None, capacity=2 ** 16):
+        self.frame_period = frame_period
+        self.threshold = threshold if threshold is not None else 1.5 * frame_period
+
+        self._times = np.empty(capacity)
+        self._scored = np.empty(capacity, dtype=bool)  # If the interval before each flip is scored
+        self._gap = False
+        self.count = 0
+
+    @property
+    def times(self):
+        """The recorded flip timestamps."""
+        return self._times[:self.count]
+
+    def record(self, flip_time):
+        """
+        Records a flip timestamp.
+
+        Parameters:
+            flip_time -- The time of the flip in seconds.
+        """
+        if self.count == self._times.shape[0]:
+            self._times = np.concatenate([self._times, np.empty_like(self._times)])
+            self._scored = np.concatenate([self._scored, np.empty_like(self._scored)])
+
+        self._times[self.count] = flip_time
+        self._scored[self.count] = not self._gap
+        self._gap = False
+        self.count += 1
+
+    def mark_gap(self):
+        """
+        Marks a pause in flipping, so the interval before the next flip is not scored.
+
+        Use this when the next flip is not expected one frame after the last one, e.g. after waiting.
+        """
+        self._gap = True
+
+    def _all_intervals(self, start, end):
+        """Returns the intervals between flips and whether each one is scored."""
+        return np.diff(self.times[start:end]), self._scored[:self.count][start:end][1:]
+
+    def intervals(self, start=0, end=None):
+        """
+        Returns the scored intervals between flips.
+
+        Parameters:
+            start -- The index of the first flip to include.
+            end -- The index after the last flip to include (defaults to all flips).
+        """
+        intervals, scored = self._all_intervals(start, end)
+        return intervals[scored]
+
+    def long_frames(self, start=0, end=None):
+        """
+        Returns the indexes of the flips that came later than the threshold.
+
+        Parameters:
+            start -- The index of the first flip to include.
+            end -- The index after the last flip to include (defaults to all flips).
+        """
+        intervals, scored = self._all_intervals(start, end)
+        return np.flatnonzero((intervals > self.threshold) & scored) + start + 1
+
+    def summary(self, bin_width=0.0005, max_interval=0.1):
+        """
+        Returns a dict summarizing the frame intervals.
+
+        Parameters:
+            bin_width -- The width of the histogram bins in seconds.
+            max_interval -- The upper edge of the histogram. Longer intervals go in the last bin.
+        """
+        intervals = self.intervals()
+        edges = np.arange(0, max_interval + bin_width / 2, bin_width)
+        counts, edges = np.histogram(np.minimum(intervals, max_interval), edges)
+
+        summary = {
+            'frame_period': self.frame_period,
+            'threshold': self.threshold,
+            'flips': self.count,
+            'scored_intervals': int(intervals.shape[0]),
+            'long_frames': int((intervals > self.threshold).sum()),
+            'histogram_edges': edges.tolist(),
+            'histogram_counts': counts.tolist(),
+        }
+
+        if intervals.shape[0]:
+            summary.update({
+                'mean_interval': float(intervals.mean()),
+                'sd_interval': float(intervals.std()),
+                'max_interval': float(intervals.max()),
+                'percentiles': dict(zip(
+                    ['1', '50', '99'], np.percentile(intervals, [1, 50, 99]).tolist())),
+            })
+
+        return summary
+
+    def save(self, filename):
+        """
+        Writes a json summary including a histogram of the frame intervals.
+
+        Parameters:
+            filename -- The path of the json file.
+        """
+        tmp_filename = filename + '.tmp'
+
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.summary(), f)
+
+        os.replace(tmp_filename, filename)
+
+
+class LatencyHistogram(object):
+    """
+    A fixed size histogram of durations with log spaced bins.
+
+    Adding a duration only updates a few numbers, so durations can be added for a whole session
+    without the memory growing.
+
+    Parameters:
+    min_duration -- The upper edge of the first bin in seconds. Shorter durations go in the first bin.
+    max_duration -- The lower edge of the last bin in seconds. Longer durations go in the last bin.
+    bins_per_decade -- The number of bins per factor of 10.
+
+    Methods:
+    add -- Adds a duration.
+    percentile -- Estimates a percentile from the histogram.
+    summary -- Returns a dict summarizing the durations.
+    """
+    def __init__(self, min_duration=1e-6, max_duration=100, bins_per_decade=10):
+        self.min_duration = min_duration
+        self.bins_per_decade = bins_per_decade
+
+        n_bins = int(round(math.log10(max_duration / min_duration) * bins_per_decade)) + 2
+        self.edges = min_duration * 10 ** (np.arange(n_bins - 1) / bins_per_decade)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, duration):
+        """
+        Adds a duration.
+
+        Parameters:
+            duration -- The duration in seconds.
+        """
+        if duration <= self.min_duration:
+            index = 0
+        else:
+            index = min(int(math.log10(duration / self.min_duration) * self.bins_per_decade) + 1,
+                        self.counts.shape[0] - 1)
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        self.total_squares += duration * duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+
+    def percentile(self, q):
+        """
+        Estimates a percentile from the histogram.
+
+        Returns the upper edge of the bin the percentile falls in, limited to the largest duration.
+
+        Parameters:
+            q -- The percentile, from 0 to 100.
+        """
+        if not self.count:
+            return None
+
+        index = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        upper = self.edges[index] if index < self.edges.shape[0] else math.inf
+
+        return float(min(upper, self.max))
+
+    def summary(self):
+        """Returns a dict with the count, mean, sd, min, max, estimated percentiles and the non-empty bins."""
+        if not self.count:
+            return {'count': 0}
+
+        mean = self.total / self.count
+        nonzero = np.flatnonzero(self.counts)
+
+        return {
+            'count': self.count,
+            'mean': mean,
+            'sd': math.sqrt(max(self.total_squares / self.count - mean * mean, 0)),
+            'min': self.min,
+            'max': self.max,
+            'percentiles': {str(q): self.percentile(q) for q in (50, 90, 99)},
+            'histogram_upper_edges': [float(self.edges[i]) if i < self.edges.shape[0] else None for i in nonzero],
+            'histogram_counts': self.counts[nonzero].tolist(),
+        }
+
+
+class _Phase(object):
+    """Times one phase, reused every time the phase runs."""
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = self.profiler.clock()
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.profiler.clock() - self.start)
+
+
+class PhaseProfiler(object):
+    """
+    Times the phases of each trial and runs chosen trials under cProfile.
+
+    Phases that run more than once in a trial are added up, and each trial adds one duration per
+    phase to a LatencyHistogram. Phases timed outside of a trial are added when they end.
+
+    Parameters:
+    profile_trials -- A collection of (block_num, trial_num) pairs to run under cProfile.
+    top_functions -- The number of functions, by cumulative time, saved for each cProfile'd trial.
+    clock -- A function returning the current time in seconds.
+
+    Methods:
+    end_trial -- Adds the phase durations of the trial to the histograms.
+    phase -- Returns a context manager that times a phase.
+    record -- Adds a duration to a phase.
+    report -- Returns the phase summaries and the cProfile results.
+    save -- Writes the report to a json file.
+    start_trial -- Starts timing a trial.
+    """
+    def __init__(self, profile_trials=(), top_functions=30, clock=time.perf_counter):
+        self.profile_trials = {tuple(pair) for pair in profile_trials}
+        self.top_functions = top_functions
+        self.clock = clock
+
+        self.histograms = {}
+        self.profiles = []
+        self.trials = 0
+
+        self._phases = {}
+        self._trial = None
+        self._durations = None
+        self._cprofile = None
+
+    def phase(self, name):
+        """
+        Returns a context manager that times a phase.
+
+        Parameters:
+            name -- The name of the phase.
+        """
+        phase = self._phases.get(name)
+        if phase is None:
+            phase = self._phases[name] = _Phase(self, name)
+        return phase
+
+    def record(self, name, duration):
+        """
+        Adds a duration to a phase.
+
+        Parameters:
+            name -- The name of the phase.
+            duration -- The duration in seconds.
+        """
+        if self._durations is not None:
+            self._durations[name] = self._durations.get(name, 0) + duration
+        else:
+            self._add(name, duration)
+
+    def _add(self, name, duration):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.add(duration)
+
+    def start_trial(self, block_num, trial_num):
+        """
+        Starts timing a trial, and starts cProfile if it is one of self.profile_trials.
+
+        Parameters:
+            block_num -- The block number of the trial.
+            trial_num -- The trial number of the trial.
+        """
+        self._trial = (block_num, trial_num)
+        self._durations = {}
+
+        if self._trial in self.profile_trials:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def end_trial(self):
+        """Adds the phase durations of the trial to the histograms."""
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self.profiles.append(self._profile_summary(self._cprofile))
+            self._cprofile = None
+
+        for name, duration in self._durations.items():
+            self._add(name, duration)
+
+        self.trials += 1
+        self._trial = None
+        self._durations = None
+
+    def _profile_summary(self, profile):
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        functions = []
+
+        for (filename, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+            functions.append({
+                'function': '{}:{}({})'.format(os.path.basename(filename), line, function),
+                'calls': calls,
+                'total': total,
+                'cumulative': cumulative,
+            })
+
+        functions.sort(key=lambda f: f['cumulative'], reverse=True)
+
+        return {
+            'block': self._trial[0],
+            'trial': self._trial[1],
+            'total': stats.total_tt,
+            'functions': functions[:self.top_functions],
+        }
+
+    def report(self):
+        """Returns a dict with the number of trials, a summary of every phase and the cProfile results."""
+        return {
+            'trials': self.trials,
+            'phases': {name: histogram.summary() for name, histogram in self.histograms.items()},
+            'profiled_trials': self.profiles,
+        }
+
+    def save(self, filename):
+        """
+        Writes the report to a json file.
+
+        Parameters:
+            filename -- The path of the json file.
+        """
+        tmp_filename = filename + '.tmp'
+
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+        os.replace(tmp_filename, filename)
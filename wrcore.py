@@ -0,0 +1,581 @@
+"""The trial logic of ResolutionWR, which does not need a display or PsychoPy.
+
+ResolutionWR inherits it to run the experiment and simulate uses it to run model observers
+through the same trials.
+
+Classes:
+ResponseGeometry -- Finds the response wheel and color under the mouse.
+TrialGenerator -- Loads the color wheel, generates trials and calculates errors.
+
+Functions:
+convert_color_value -- Converts a 0 to 255 rgb color to -1 to 1.
+trial_dtype -- Returns the numpy structured dtype of a trial record.
+"""
+
+
+import hashlib
+import json
+import math
+import numbers
+import os
+
+import numpy as np
+
+
+def convert_color_value(color):
+    """
+    Converts a 0 to 255 rgb color to -1 to 1, rounded like template.convert_color_value.
+
+    Parameters:
+        color -- A list of 3 numbers from 0 to 255.
+    """
+    return [round(n / 127.5 - 1, 2) for n in color]
+
+
+def trial_dtype(max_set_size, wheel_size):
+    """
+    Returns the numpy structured dtype of a trial record.
+
+    A record holds the set size and the color indexes, wheel rotations and (x, y) locations of every
+    item. Trials with fewer items than max_set_size are padded with -1 indexes and nan locations.
+    Colors are stored as wheel indexes, see TrialGenerator.expand_trial for the rgb values.
+
+    Parameters:
+        max_set_size -- The largest set size a record has to hold.
+        wheel_size -- The number of colors on the color wheel.
+    """
+    index_type = np.int16 if wheel_size <= np.iinfo(np.int16).max else np.int32
+
+    return np.dtype([
+        ('set_size', np.int16),
+        ('color_indexes', index_type, (max_set_size,)),
+        ('wheel_rotations', index_type, (max_set_size,)),
+        ('locations', np.float64, (max_set_size, 2)),
+    ])
+
+
+class ResponseGeometry(object):
+    """
+    Finds the response wheel and color under the mouse.
+
+    The wheel centers are sorted into a grid of cells as wide as a wheel's radius, so a query only
+    looks at the wheels in the 3x3 cells around the mouse however many wheels there are. Wheels are
+    referred to by their location index, so locations do not need to be unique.
+
+    Parameters:
+    locations -- A list of (x, y) wheel centers.
+    wheel_rotations -- A list of ints (0 to wheel_size - 1) describing how much each wheel is rotated.
+    outer_radius -- The outer radius of the colored ring of each wheel.
+    inner_radius -- The inner radius of the colored ring of each wheel.
+    wheel_size -- The number of colors on the color wheel.
+
+    Methods:
+    color_index -- Returns the color wheel index under a position on a wheel.
+    hit -- Returns the wheel and color index under a position.
+    remove -- Removes an answered wheel.
+    wheel_at -- Returns the index of the wheel whose colored ring is under a position.
+    """
+    def __init__(self, locations, wheel_rotations, outer_radius, inner_radius, wheel_size):
+        self.centers = [(float(x), float(y)) for x, y in np.asarray(locations, dtype=float).reshape(-1, 2)]
+        self.rotations = [int(rot) for rot in wheel_rotations]
+        self.outer_radius = outer_radius
+        self.inner_radius = inner_radius
+        self.wheel_size = wheel_size
+        self.remaining = len(self.centers)
+
+        self._cells = {}
+        for i, (x, y) in enumerate(self.centers):
+            self._cells.setdefault(self._cell(x, y), []).append(i)
+
+    def _cell(self, x, y):
+        return math.floor(x / self.outer_radius), math.floor(y / self.outer_radius)
+
+    def wheel_at(self, pos):
+        """
+        Returns the index of the wheel whose colored ring is under a position, or None.
+
+        If rings overlap, the wheel with the closest center is used.
+
+        Parameters:
+            pos -- An (x, y) position, e.g. from mouse.getPos().
+        """
+        x, y = float(pos[0]), float(pos[1])
+        cell_x, cell_y = self._cell(x, y)
+
+        closest, closest_dist = None, math.inf
+
+        for i in (cell_x - 1, cell_x, cell_x + 1):
+            for j in (cell_y - 1, cell_y, cell_y + 1):
+                for wheel in self._cells.get((i, j), ()):
+                    center_x, center_y = self.centers[wheel]
+                    dist = math.hypot(x - center_x, y - center_y)
+                    if self.inner_radius <= dist <= self.outer_radius and dist < closest_dist:
+                        closest, closest_dist = wheel, dist
+
+        return closest
+
+    def color_index(self, wheel, pos):
+        """
+        Returns the color wheel index under a position on a wheel.
+
+        Parameters:
+            wheel -- The index of the wheel.
+            pos -- An (x, y) position on the wheel.
+        """
+        center_x, center_y = self.centers[wheel]
+        angle = math.degrees(math.atan2(pos[0] - center_x, pos[1] - center_y)) % 360  # clockwise from the top
+
+        return (int(angle * self.wheel_size / 360) - self.rotations[wheel]) % self.wheel_size
+
+    def hit(self, pos):
+        """
+        Returns the (wheel, color index) under a position, or None if it is not on a wheel.
+
+        Parameters:
+            pos -- An (x, y) position, e.g. from mouse.getPos().
+        """
+        wheel = self.wheel_at(pos)
+
+        if wheel is None:
+            return None
+
+        return wheel, self.color_index(wheel, pos)
+
+    def remove(self, wheel):
+        """
+        Removes an answered wheel, so it is no longer found by wheel_at.
+
+        Parameters:
+            wheel -- The index of the wheel.
+        """
+        cell = self._cells[self._cell(*self.centers[wheel])]
+
+        if wheel in cell:
+            cell.remove(wheel)
+            self.remaining -= 1
+
+
+class TrialGenerator(object):
+    """
+    Loads the color wheel, generates trials and calculates errors.
+
+    Parameters:
+    set_sizes -- A list of all the set sizes.
+    trials_per_set_size -- The number of trials per set size per block.
+    number_of_blocks -- The number of blocks in the experiment.
+    distance_from_fixation -- How far from fixation stimuli appear in visual degrees.
+    min_color_dist -- The minimum number of degrees in color space between display items.
+    colorwheel_path -- A string or Path describing the location of a json file containing
+        an array of length 3 rgb arrays (0 to 255).
+    wheel_size -- The number of colors on the color wheel. Defaults to the length of the file.
+    nearest_color_fallback -- If True, response colors that do not exactly match a color wheel entry
+        are matched to the closest entry instead of giving no error.
+    seed -- Seed for the random number generator used to create trials.
+    convert_color_value -- The function that converts the 0 to 255 colors of the file to -1 to 1.
+    kwargs -- Sent to the next class in the method resolution order.
+
+    Methods:
+    calculate_error -- Calculates error in a response compared to the true color value.
+    calculate_errors -- Calculates the errors for arrays of true and response color indexes.
+    calculate_locations -- Calculates locations for the upcoming trial with random jitter.
+    color_to_index -- Finds the color wheel index of an rgb color.
+    distinct_colors -- Returns the number of different colors on the color wheel.
+    generate_color_indexes -- Generates colors for a trial given the minimum distance.
+    expand_block -- Converts an array of trial records into a list of trial dictionaries.
+    expand_trial -- Converts a trial record into the trial dictionary used by run_trial and the hooks.
+    make_block -- Creates a list of trials to be run.
+    make_session -- Creates the blocks for a whole session.
+    make_session_records -- Creates the blocks for a whole session as arrays of trial records.
+    make_trial -- Creates a single trial dictionary.
+    make_trials -- Creates a list of trial dictionaries for one set size.
+    trial_arrays -- Generates the random values for a number of trials of one set size.
+    trial_records -- Generates an array of trial records for one set size.
+    """
+    def __init__(self, set_sizes, trials_per_set_size, number_of_blocks, distance_from_fixation,
+                 min_color_dist, colorwheel_path, wheel_size=None, nearest_color_fallback=False, seed=None,
+                 convert_color_value=convert_color_value, **kwargs):
+        self.set_sizes = set_sizes
+        self.trials_per_set_size = trials_per_set_size
+        self.number_of_blocks = number_of_blocks
+        self.distance_from_fixation = distance_from_fixation
+        self.min_color_dist = min_color_dist
+        self.nearest_color_fallback = nearest_color_fallback
+
+        self._load_color_wheel(colorwheel_path, wheel_size, convert_color_value)
+        self.trial_dtype = trial_dtype(max(set_sizes), self.wheel_size)
+        self.rng = np.random.default_rng(seed)
+
+        for set_size in self.set_sizes:
+            self._check_color_dist(set_size)
+
+        super().__init__(**kwargs)
+
+    def _resample_color_wheel(self, color_wheel, wheel_size):
+        """
+        Resamples a color wheel to a different number of colors using circular linear interpolation.
+
+        Parameters:
+            color_wheel -- An (n, 3) array of 0 to 255 rgb values.
+            wheel_size -- The number of colors to return.
+        """
+        positions = np.arange(wheel_size) * color_wheel.shape[0] / wheel_size
+        below = np.floor(positions).astype(int)
+        above = (below + 1) % color_wheel.shape[0]
+        weight = (positions - below)[:, np.newaxis]
+
+        return np.rint(color_wheel[below] * (1 - weight) + color_wheel[above] * weight)
+
+    def _load_color_wheel(self, path, wheel_size=None, convert=convert_color_value):
+        """
+        Loads the json color wheel file.
+
+        The loaded wheel is cached in a .npy file next to the json file, named with a hash of the
+        file contents and the wheel size, which is memory mapped instead of parsing the json again.
+
+        Sets self.color_wheel (-1 to 1 rgb values), self.color_wheel_rgb (0 to 255 rgb values) and
+        self.wheel_size, and builds the reverse lookup from -1 to 1 rgb values to wheel indexes used
+        by color_to_index.
+
+        Parameters:
+            path -- Str or Path of the json file.
+            wheel_size -- The number of colors on the wheel. If it differs from the length of the
+                file, the wheel is resampled. Defaults to the length of the file.
+            convert -- The function that converts a 0 to 255 rgb color to -1 to 1.
+        """
+        path = str(path)
+
+        with open(path, 'rb') as f:
+            contents = f.read()
+
+        key = hashlib.sha1(contents)
+        key.update(str(wheel_size).encode())
+        key.update(str(convert([0, 128, 255])).encode())  # in case the conversion changes
+        cache_path = os.path.splitext(path)[0] + '.' + key.hexdigest()[:16] + '.npy'
+
+        try:
+            wheels = np.load(cache_path, mmap_mode='r')
+        except (OSError, ValueError):
+            color_wheel = np.array(json.loads(contents.decode('utf-8')), dtype=float)
+
+            if wheel_size is not None and wheel_size != color_wheel.shape[0]:
+                color_wheel = self._resample_color_wheel(color_wheel, wheel_size)
+
+            converted = [convert(i) for i in color_wheel.tolist()]
+            wheels = np.stack([color_wheel, np.array(converted, dtype=float)])
+
+            try:
+                with open(cache_path + '.tmp', 'wb') as f:
+                    np.save(f, wheels)
+                os.replace(cache_path + '.tmp', cache_path)
+            except OSError:
+                pass  # The cache is optional, e.g. if the folder is read only
+
+        self.color_wheel_rgb = wheels[0].astype(int)
+        self.color_wheel = np.asarray(wheels[1])
+        self.wheel_size = self.color_wheel.shape[0]
+
+        # Neighboring entries can convert to the same color, the first index is used for those
+        self._color_indexes = {}
+        for i, color in enumerate(self.color_wheel.tolist()):
+            self._color_indexes.setdefault(tuple(color), i)
+
+    def calculate_locations(self, set_size, n_trials=None):
+        """
+        Calculates locations for the upcoming trial with random jitter.
+
+        Parameters:
+            set_size -- The number of locations to return.
+            n_trials -- If given, an (n_trials, set_size, 2) array with the locations for that many
+                trials is returned instead of a list.
+        """
+        n = 1 if n_trials is None else n_trials
+
+        angle_dist = 360 / set_size
+        rotation = self.rng.integers(0, int(angle_dist), size=(n, 1))
+        jitter = self.rng.integers(-5, 6, size=(n, set_size))
+        angles = np.radians(np.trunc(np.arange(set_size) * angle_dist + rotation + jitter))
+
+        locations = self.distance_from_fixation * np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+
+        if n_trials is None:
+            return [tuple(loc) for loc in locations[0].tolist()]
+
+        return locations
+
+    def _min_color_index_dist(self):
+        """Returns min_color_dist (in degrees) as a number of wheel entries."""
+        return math.ceil(self.min_color_dist * self.wheel_size / 360)
+
+    def _check_color_dist(self, set_size):
+        """
+        Raises a ValueError if set_size colors can't be min_color_dist apart on the color wheel.
+
+        Parameters:
+            set_size -- The number of colors that will be generated.
+        """
+        if set_size > 1 and set_size * self._min_color_index_dist() > self.wheel_size:
+            raise ValueError(
+                'Can not generate {} colors that are at least {} degrees apart on the color wheel.'.format(
+                    set_size, self.min_color_dist))
+
+    def generate_color_indexes(self, set_size, n_trials=None):
+        """
+        Generates colors for a trial given the minimum distance.
+
+        Valid color sets are built directly instead of by rejection. The gaps between neighboring
+        colors are the minimum distance plus a random share of the leftover space and the whole set
+        is rotated by a random amount, which makes every valid set equally likely.
+
+        Parameters:
+            set_size -- The number of colors to generate.
+            n_trials -- If given, an (n_trials, set_size) array with the colors for that many trials
+                is returned instead of a list.
+        """
+        self._check_color_dist(set_size)
+
+        n = 1 if n_trials is None else n_trials
+
+        offsets = np.zeros((n, set_size), dtype=int)
+
+        if set_size > 1:
+            min_dist = self._min_color_index_dist()
+            slots = self.wheel_size - set_size * min_dist + set_size - 1
+
+            # Picking set_size - 1 dividers out of the slots splits the leftover space uniformly
+            dividers = np.sort(self.rng.random((n, slots)).argsort(axis=1)[:, :set_size - 1], axis=1)
+            extra = np.diff(dividers, axis=1, prepend=-1, append=slots) - 1
+            offsets[:, 1:] = np.cumsum(min_dist + extra[:, :-1], axis=1)
+
+        colors = (offsets + self.rng.integers(0, self.wheel_size, size=(n, 1))) % self.wheel_size
+        colors = np.take_along_axis(colors, self.rng.random((n, set_size)).argsort(axis=1), axis=1)
+
+        if n_trials is None:
+            return colors[0].tolist()
+
+        return colors
+
+    def trial_arrays(self, set_size, n_trials):
+        """
+        Generates the random values for n_trials trials of one set size.
+
+        Returns (color_indexes, wheel_rotations, locations) arrays with shapes (n_trials, set_size),
+        (n_trials, set_size) and (n_trials, set_size, 2).
+
+        Parameters:
+            set_size -- The number of items to be displayed.
+            n_trials -- The number of trials to create.
+        """
+        color_indexes = self.generate_color_indexes(set_size, n_trials)
+        wheel_rotations = self.rng.integers(0, self.wheel_size, size=(n_trials, set_size))
+        locations = self.calculate_locations(set_size, n_trials)
+
+        return color_indexes, wheel_rotations, locations
+
+    def trial_records(self, set_size, n_trials):
+        """
+        Generates an array of trial records for one set size.
+
+        Returns a structured array with self.trial_dtype, which takes far less memory than trial
+        dictionaries. The random values are the same as the ones make_trials would use.
+
+        Parameters:
+            set_size -- The number of items to be displayed.
+            n_trials -- The number of trials to create.
+        """
+        color_indexes, wheel_rotations, locations = self.trial_arrays(set_size, n_trials)
+
+        records = np.zeros(n_trials, dtype=self.trial_dtype)
+        records['set_size'] = set_size
+        records['color_indexes'] = -1
+        records['color_indexes'][:, :set_size] = color_indexes
+        records['wheel_rotations'] = -1
+        records['wheel_rotations'][:, :set_size] = wheel_rotations
+        records['locations'] = np.nan
+        records['locations'][:, :set_size] = locations
+
+        return records
+
+    def expand_trial(self, record):
+        """
+        Converts a trial record into the trial dictionary used by run_trial and the hooks.
+
+        The dictionary has the set_size, color_indexes, color_values (rows of self.color_wheel),
+        wheel_rotations and locations of the trial.
+
+        Parameters:
+            record -- One element of an array returned by trial_records or make_session_records. Trial
+                dictionaries are returned unchanged, so blocks made by make_block can be expanded too.
+        """
+        if isinstance(record, dict):
+            return record
+
+        set_size = int(record['set_size'])
+        colors = record['color_indexes'][:set_size]
+
+        return {
+            'set_size': set_size,
+            'color_indexes': colors.tolist(),
+            'color_values': list(self.color_wheel[colors]),
+            'wheel_rotations': record['wheel_rotations'][:set_size].tolist(),
+            'locations': [tuple(loc) for loc in record['locations'][:set_size].tolist()],
+        }
+
+    def expand_block(self, records):
+        """
+        Converts an array of trial records into a list of trial dictionaries.
+
+        Parameters:
+            records -- An array returned by trial_records or make_session_records, or a block of
+                trial dictionaries, which are returned unchanged.
+        """
+        return [self.expand_trial(record) for record in records]
+
+    def make_trials(self, set_size, n_trials):
+        """
+        Creates a list of trial dictionaries for one set size.
+
+        All of the random values are generated at once, so this is much faster than calling
+        make_trial repeatedly.
+
+        Parameters:
+            set_size -- The number of items to be displayed.
+            n_trials -- The number of trials to create.
+        """
+        return self.expand_block(self.trial_records(set_size, n_trials))
+
+    def make_trial(self, set_size):
+        """
+        Creates a single trial dictionary.
+
+        Parameters:
+            set_size -- The number of items to be displayed.
+        """
+        return self.make_trials(set_size, 1)[0]
+
+    def make_session_records(self, number_of_blocks=None):
+        """
+        Creates the blocks for a whole session as arrays of trial records.
+
+        Returns a list with a shuffled structured array (see trial_records) for each block. The trials
+        for every block are generated in one pass per set size.
+
+        Parameters:
+            number_of_blocks -- The number of blocks to create (defaults to self.number_of_blocks).
+        """
+        if number_of_blocks is None:
+            number_of_blocks = self.number_of_blocks
+
+        per_block = self.trials_per_set_size
+        records = [self.trial_records(set_size, per_block * number_of_blocks).reshape(number_of_blocks, per_block)
+                   for set_size in self.set_sizes]
+        blocks = np.concatenate(records, axis=1)
+
+        return [block[self.rng.permutation(len(block))] for block in blocks]
+
+    def _overridden(self, name):
+        """Returns True if a subclass has overwritten the TrialGenerator method called name."""
+        return getattr(type(self), name) is not getattr(TrialGenerator, name)
+
+    def make_session(self, number_of_blocks=None):
+        """
+        Creates the blocks for a whole session.
+
+        Returns a list of blocks. If make_block or make_trial have been overwritten, make_block is called
+        for every block and the blocks are lists of trial dictionaries. Otherwise the trials of every
+        block are generated at once by make_session_records and kept as arrays of trial records.
+        expand_block and expand_trial convert either kind of block or trial into trial dictionaries.
+
+        Parameters:
+            number_of_blocks -- The number of blocks to create (defaults to self.number_of_blocks).
+        """
+        if number_of_blocks is None:
+            number_of_blocks = self.number_of_blocks
+
+        if self._overridden('make_block') or self._overridden('make_trial'):
+            return [self.make_block() for _ in range(number_of_blocks)]
+
+        return self.make_session_records(number_of_blocks)
+
+    def make_block(self):
+        """Makes a block of trials.
+
+        Returns a shuffled list of trials created by self.make_trial. If make_trial has not been
+        overwritten, the trials of each set size are generated at once instead.
+        """
+        if not self._overridden('make_trial'):
+            return self.expand_block(self.make_session_records(1)[0])
+
+        trials = [self.make_trial(set_size) for set_size in self.set_sizes for _ in range(self.trials_per_set_size)]
+
+        return [trials[i] for i in self.rng.permutation(len(trials))]
+
+    def color_to_index(self, color, nearest=None):
+        """
+        Finds the color wheel index of an rgb color.
+
+        Returns None if the color is not on the wheel and the nearest color fallback is off.
+
+        Parameters:
+            color -- A -1 to 1 rgb color.
+            nearest -- If True, colors not on the wheel are matched to the closest wheel color.
+                Defaults to self.nearest_color_fallback.
+        """
+        color = tuple(np.asarray(color, dtype=float).tolist())
+        index = self._color_indexes.get(color)
+
+        if nearest is None:
+            nearest = self.nearest_color_fallback
+
+        if index is None and nearest:
+            index = int(np.argmin(((self.color_wheel - color) ** 2).sum(axis=1)))
+
+        return index
+
+    def distinct_colors(self):
+        """
+        Returns the number of different colors on the color wheel.
+
+        Neighboring entries can have the same -1 to 1 color, especially when a wheel is resampled to more
+        entries than the file has, and color_to_index can only return the first of them.
+        """
+        return len(self._color_indexes)
+
+    def calculate_errors(self, color_indexes, resp_indexes):
+        """
+        Calculates the errors for arrays of true and response color indexes.
+
+        Errors are in wheel entries and are wrapped to plus or minus half of the wheel size. Any
+        array shape works, so a whole trial or a whole session can be calculated at once.
+
+        Parameters:
+            color_indexes -- An array of the true color indexes (0 to wheel_size - 1).
+            resp_indexes -- An array of the selected color indexes (0 to wheel_size - 1).
+        """
+        raw_error = np.asarray(resp_indexes) - np.asarray(color_indexes)
+
+        # Rounding half to even keeps errors of exactly half the wheel as they are
+        error = raw_error - self.wheel_size * np.round(raw_error / self.wheel_size)
+
+        if np.issubdtype(raw_error.dtype, np.integer):
+            error = error.astype(raw_error.dtype)
+
+        return error
+
+    def calculate_error(self, color_index, resp_color):
+        """
+        Calculates error in a response compared to the true color value.
+
+        Parameters:
+            color_index -- The index of the true color values (0 to wheel_size - 1).
+            resp_color -- The color wheel index that was selected, or its -1 to 1 rgb color. Neighboring
+                wheel entries can have the same rgb color, so only an index gives the exact error.
+        """
+        if isinstance(resp_color, numbers.Integral):
+            resp_index = resp_color
+        else:
+            resp_index = self.color_to_index(resp_color)
+
+        if resp_index is None:
+            return None
+
+        return int(self.calculate_errors(color_index, resp_index))
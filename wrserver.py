@@ -0,0 +1,238 @@
+"""A reference collection server for datasinks.NetworkSink.
+
+Every station running ResolutionWR with data_server set sends its trials here. Each batch is appended
+to combined.csv, which has a Station column added, and to a copy of the station's data file under
+<output>/<station>/. The ids of stored batches are recorded, so a batch that is sent again after a
+lost reply is only stored once. If a batch can not be written completely, whatever was written of it
+is removed again, so a batch is either stored in every file or in none.
+
+Usage:
+    python wrserver.py --port 8000 --output collected
+
+Classes:
+CollectionServer -- An HTTP server that stores batches of rows sent by NetworkSink.
+
+Functions:
+safe_name -- Makes a station or file name safe to use as a file name.
+"""
+
+
+import argparse
+import csv
+import gzip
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+
+
+def safe_name(name):
+    """
+    Makes a station or file name safe to use as a file name.
+
+    Parameters:
+        name -- The name sent by the station.
+    """
+    name = re.sub(r'[^\w.()-]', '_', str(name)).lstrip('.')
+    return name or '_'
+
+
+class _BatchHandler(http.server.BaseHTTPRequestHandler):
+    def _reply(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/batches':
+            self._reply(404, {'error': 'unknown path'})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)  # Raises an OSError if the data is not gzip
+            batch = json.loads(body.decode('utf-8'))
+        except (OSError, ValueError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+
+        try:
+            stored = self.server.store(batch)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        except OSError as e:
+            # A problem on the server (e.g. a full disk), so the station keeps the batch and tries again
+            self._reply(503, {'error': str(e)})
+            return
+
+        self._reply(200, {'stored': stored})
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._reply(404, {'error': 'unknown path'})
+            return
+
+        self._reply(200, self.server.status())
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class CollectionServer(http.server.ThreadingHTTPServer):
+    """
+    An HTTP server that stores batches of rows sent by NetworkSink.
+
+    Batches are POSTed as (optionally gzip compressed) json to /batches, and GET /status returns the
+    number of batches and rows stored from each station. Batches that can not be read get a 400 reply,
+    and batches that could not be written get a 503 reply, so the station sends them again later.
+
+    Parameters:
+    address -- A (host, port) tuple. Use port 0 to pick a free port.
+    output_directory -- Where the combined dataset and the station files are written.
+    quiet -- If True, requests are not logged.
+
+    Methods:
+    status -- Returns the number of batches and rows stored from each station.
+    store -- Stores a batch and returns the number of rows written.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, output_directory, quiet=False):
+        super().__init__(address, _BatchHandler)
+
+        self.output_directory = output_directory
+        self.quiet = quiet
+        self._lock = threading.Lock()
+        self._counts = {}
+
+        os.makedirs(output_directory, exist_ok=True)
+
+        self._ids_filename = os.path.join(output_directory, 'received_batches.txt')
+        self._combined_filename = os.path.join(output_directory, 'combined.csv')
+
+        self._received = set()
+        if os.path.isfile(self._ids_filename):
+            with open(self._ids_filename) as f:
+                self._received = set(f.read().split())
+
+        self._combined_fields = None
+        if os.path.isfile(self._combined_filename):
+            with open(self._combined_filename, newline='') as f:
+                self._combined_fields = next(csv.reader(f), None)
+
+    def _append(self, filename, header, rows, written):
+        # Records the size of the file before appending in written, so the append can be undone
+        new = not os.path.isfile(filename)
+        written.append((filename, None if new else os.path.getsize(filename)))
+
+        with open(filename, 'a', newline='') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            if new:
+                writer.writerow(header)
+            writer.writerows(rows)
+
+    def _undo(self, written):
+        # Removes what was appended to each file, in reverse order
+        for filename, size in reversed(written):
+            if size is None:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+            else:
+                with open(filename, 'r+b') as f:
+                    f.truncate(size)
+
+    def store(self, batch):
+        """
+        Stores a batch and returns the number of rows written.
+
+        Batches that have already been stored are ignored. Raises a ValueError if a row does not
+        have one value per field. If writing raises an OSError, the parts of the batch that were
+        written are removed before it is raised again, so the batch can be sent again.
+
+        Parameters:
+            batch -- A dict with id, station, source, fields and rows, as sent by NetworkSink.
+        """
+        batch_id = safe_name(batch['id'])
+        station = safe_name(batch['station'])
+        fields = list(batch['fields'])
+        rows = [list(row) for row in batch['rows']]
+
+        for row in rows:
+            if len(row) != len(fields):
+                raise ValueError('A row has {} values but there are {} fields.'.format(len(row), len(fields)))
+
+        with self._lock:
+            if batch_id in self._received:
+                return 0
+
+            combined_fields = self._combined_fields
+            if combined_fields is None:
+                combined_fields = ['Station'] + fields
+
+            # Columns are matched by name in case stations run with different data fields
+            columns = {field: i for i, field in enumerate(fields)}
+            combined = [[station] + [row[columns[field]] if field in columns else 'NA'
+                                     for field in combined_fields[1:]] for row in rows]
+
+            written = []
+            try:
+                os.makedirs(os.path.join(self.output_directory, station), exist_ok=True)
+                self._append(os.path.join(self.output_directory, station, safe_name(batch['source'])),
+                             fields, rows, written)
+                self._append(self._combined_filename, combined_fields, combined, written)
+
+                written.append((self._ids_filename, os.path.getsize(self._ids_filename)
+                                if os.path.isfile(self._ids_filename) else None))
+                with open(self._ids_filename, 'a') as f:
+                    f.write(batch_id + '\n')
+            except OSError:
+                self._undo(written)
+                raise
+
+            self._combined_fields = combined_fields
+            self._received.add(batch_id)
+
+            counts = self._counts.setdefault(station, {'batches': 0, 'rows': 0})
+            counts['batches'] += 1
+            counts['rows'] += len(rows)
+
+        return len(rows)
+
+    def status(self):
+        """Returns the number of batches and rows stored from each station since the server started."""
+        with self._lock:
+            return {station: dict(counts) for station, counts in self._counts.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='', help='The address to listen on (default all addresses).')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--output', default='collected', help='Where to write the collected data.')
+    parser.add_argument('--quiet', action='store_true', help='Do not log every request.')
+    args = parser.parse_args(argv)
+
+    server = CollectionServer((args.host, args.port), args.output, args.quiet)
+    print('Collecting data in {} on port {}'.format(args.output, server.server_address[1]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())